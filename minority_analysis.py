@@ -3,6 +3,9 @@
 import os
 import sys
 import json
+import matplotlib
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
@@ -15,17 +18,100 @@ from Bio.SeqUtils import seq1
 
 import subprocess as sp
 from glob import glob
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from contextlib import redirect_stdout, redirect_stderr
+import traceback
 import gzip
+import re
+import pickle
 from collections import defaultdict, Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import socket
+import threading
+import time
+
+GATK = "/gatk/gatk"
+SNPEFF = ["java", "-jar", "/opt/snpEff/snpEff.jar", "ann", "covid19"]
 
 
 def e(cmd):
     if os.environ.get("verbose"):
         print(cmd)
-    sp.run(cmd, shell=True)
+    return sp.run(cmd, shell=True)
+
+
+def reference_intervals(reference, n):
+    """Splits the reference sequences in n intervals of similar size ("contig:start-end", as GATK -L)"""
+    if os.path.exists(reference + ".fai"):
+        with open(reference + ".fai") as h:
+            lengths = [(line.split("\t")[0], int(line.split("\t")[1])) for line in h if line.strip()]
+    else:
+        with (gzip.open(reference, "rt") if reference.endswith(".gz") else open(reference)) as h:
+            lengths = [(record.id, len(record.seq)) for record in bpio.parse(h, "fasta")]
+    size = max(1, -(-sum(length for _, length in lengths) // n))
+    return [f"{contig}:{start}-{min(start + size - 1, length)}"
+            for contig, length in lengths for start in range(1, length + 1, size)]
+
+
+def genotype_interval(task):
+    reference, raw_vcf, interval, output = task
+    # only the records that start in the interval, so the ones in the limits are not repeated in the next one
+    cmdx = f"""{GATK} GenotypeGVCFs \
+                    -R "{reference}" -ploidy 2 \
+                    -V "{raw_vcf}" -L "{interval}" --only-output-calls-starting-in-intervals \
+                    -O "{output}"
+        """
+    if e(cmdx).returncode or not os.path.exists(output):
+        raise RuntimeError(f'GenotypeGVCFs failed in the interval {interval}')
+    return output
+
+
+def concat_vcf_parts(parts):
+    """Lines of the VCF parts (bgziped) as one VCF, in the same order, with the header of the first one.
+    Each part is removed once it is read"""
+    for idx, part in enumerate(parts):
+        with gzip.open(part, "rb") as h:
+            for line in h:
+                if idx == 0 or not line.startswith(b"#"):
+                    yield line
+        for x in [part, part + ".tbi"]:
+            if os.path.exists(x):
+                os.remove(x)
+
+
+def write_lines(lines, stream, errors):
+    # runs in its own thread, errors are kept to be raised by the main one
+    try:
+        for line in lines:
+            stream.write(line)
+    except Exception as ex:
+        errors.append(ex)
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass  # the annotation was stopped, the error is reported by the main thread
+
+
+def remove_vcf_parts(output):
+    for x in glob(f"{output}.part*.vcf.gz") + glob(f"{output}.part*.vcf.gz.tbi"):
+        os.remove(x)
+
+
+def tee_lines(lines, output):
+    with open(output, "wb") as h:
+        for line in lines:
+            h.write(line)
+            yield line
 
 
 def merge_vcfs(args):
+    """Combines the samples gvcfs and genotypes them in intervals of the reference, in parallel.
+    The genotyped intervals are streamed, in order, to snpEff (and vcffixer.py if args.fix), without intermediate
+    files. If args.isnvs_out is set, the resulting VCF is also processed by the "iSNVs" step while it is written.
+    Both outputs are written with a ".tmp" suffix and renamed when every step has finished successfully."""
     outfolder = os.path.dirname(args.output)
     if not os.path.exists(outfolder):
         os.makedirs(outfolder)
@@ -43,17 +129,72 @@ def merge_vcfs(args):
         raise FileNotFoundError(f'no .vcf or .vcf.gz files where found at {args.vcfs_dir}')
     vcfs = " ".join([f"--variant {x}" for x in vcf_files])
     # docker run -u $(id -u ${{USER}}):$(id -g ${{USER}})  -v $PWD:/out -w /out broadinstitute/gatk:4.2.2.0 \
-    cmdx = f"""/gatk/gatk CombineGVCFs -R {args.reference} {vcfs} -O {args.output}.raw.gz"""
-    e(cmdx)
-    # docker run -u $(id -u ${{USER}}):$(id -g ${{USER}})  -v $PWD:/out -w /out broadinstitute/gatk:4.2.2.0 \
-    cmdx = f"""/gatk/gatk GenotypeGVCFs \
-                    -R "{args.reference}" -ploidy 2 \
-                    -V "{args.output}.raw.gz" \
-                    -O "{args.output}.unann" 
-        """
-    e(cmdx)
-    cmdx = f"""java -jar /opt/snpEff/snpEff.jar ann covid19 "{args.output}.unann"  > "{args.output}" """
-    e(cmdx)
+    cmdx = f"""{GATK} CombineGVCFs -R {args.reference} {vcfs} -O {args.output}.raw.gz"""
+    if e(cmdx).returncode:
+        raise RuntimeError('CombineGVCFs failed')
+
+    processes = args.processes or os.cpu_count()
+    intervals = reference_intervals(args.reference, processes)
+    # parts left by an interrupted run must not be taken as genotyped intervals
+    remove_vcf_parts(args.output)
+    tasks = [(args.reference, f"{args.output}.raw.gz", interval, f"{args.output}.part{idx}.vcf.gz")
+             for idx, interval in enumerate(intervals)]
+    if os.environ.get("verbose"):
+        print(" ".join(SNPEFF))
+    vcf_tmp = f"{args.output}.tmp"
+    isnvs_tmp = f"{args.isnvs_out}.tmp" if args.isnvs_out else None
+    steps = []
+    feeder = None
+    lines = None
+    completed = False
+    with ThreadPool(processes) as pool:
+        try:
+            # imap keeps the intervals order, each one is streamed as soon as it and the previous ones are genotyped
+            annotation = sp.Popen(SNPEFF, stdin=sp.PIPE, stdout=sp.PIPE)
+            steps.append(annotation)
+            errors = []
+            feeder = threading.Thread(target=write_lines, args=(
+                concat_vcf_parts(pool.imap(genotype_interval, tasks)), annotation.stdin, errors))
+            feeder.start()
+            if args.fix:
+                vcffixer = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vcffixer.py")
+                steps.append(sp.Popen([sys.executable, vcffixer, "-"], stdin=annotation.stdout, stdout=sp.PIPE))
+                annotation.stdout.close()
+            lines = tee_lines(steps[-1].stdout, vcf_tmp)
+            if args.isnvs_out:
+                variant_filter(lines, isnvs_tmp, args.isnv_depth, args.min_coverage, args.isnv_freq,
+                               args.badq_strain_ns_threshold, checkpoint_interval=0)
+            for _ in lines:
+                pass
+            feeder.join()
+            if errors:
+                raise errors[0]
+            for step in steps:
+                if step.wait():
+                    raise RuntimeError(f'"{" ".join(step.args)}" failed')
+            completed = True
+        finally:
+            if not completed:
+                # nobody reads the pipeline anymore: stop it, so the feeder thread is not blocked writing to it
+                for step in steps:
+                    if step.poll() is None:
+                        step.kill()
+            if feeder:
+                feeder.join()
+            for step in steps:
+                step.wait()
+            if lines:
+                lines.close()
+            if not completed:
+                pool.terminate()
+                pool.join()
+                remove_vcf_parts(args.output)
+                for x in [vcf_tmp, isnvs_tmp]:
+                    if x and os.path.exists(x):
+                        os.remove(x)
+    os.replace(vcf_tmp, args.output)
+    if args.isnvs_out:
+        os.replace(isnvs_tmp, args.isnvs_out)
 
 
 def download(args):
@@ -77,39 +218,58 @@ def download(args):
     e(cmdx)
 
 
-def variant_filter(vcf_path, outpath, min_allele_depth,min_coverage,min_freq,badq_strain_ns_threshold, lineage_data={}):
-    """MN996528.1	1879	.	A	G	14552.79	.	AC=2;AF=5.556e-03;AN=360;BaseQRankSum=2.16;DP=113297;ExcessHet=0.0061;FS=0.838;InbreedingCoeff=0.8880;MLEAC=2;MLEAF=5.556e-03;MQ=59.99;MQRankSum=0.00;QD=28.76;ReadPosRankSum=1.03;SOR=0.597	GT:AD:DP:GQ:PGT:PID:PL:PS	0/0:717,0:717:99:.:.:0,120,1800	0/0:166,0:166:99:.:.:0,120,1800	0/0:395,0:395:99:.:.:0,120,1800	0/0:354,0:354:99:.:.:0,120,1800	0/0:464,0:464:99:.:.:0,120,1800	0/0:363,0:363:99:.:.:0,120,1800	0/0:464,0:464:99:.:.:0,120,1800	0/0:396,0:396:99:.:.:0,120,1800	0/0:288,0:288:99:.:.:0,120,1800	0/0:371,0:371:99:.:.:0,120,1800	0/0:347,0:347:99:.:.:0,120,1800	0/0:422,0:422:99:.:.:0,120,1800	0/0:517,0:517:99:.:.:0,120,1800	0/0:392,0:392:99:.:.:0,120,1800	0/0:392,0:392:99:.:.:0,120,1800	0/0:465,0:465:99:.:.:0,120,1800
-        """
-    if not os.path.exists(vcf_path):
-        sys.stderr.write(f"'{vcf_path}' does not exists\n")
-        sys.exit(1)
-
-    print(f"Running lowfreq variant detection with:")
-    print(f'- Minimun allele read depth: {min_allele_depth}')
-    print(f'- max %N to discard a position: {min_coverage}')
-    print(f'- minimun minority variant frequency: {min_freq}')
-    print("----------------")
-
-    lineage_variants_count = defaultdict(lambda: 0)
-    for lineajes in lineage_data.values():
-        for lin, _ in lineajes:
-            lineage_variants_count[lin] += 1
+# a sample call whose GT (first FORMAT field) has two different alleles. It is used to skip the positions without
+# minority variant candidates, so it may match other calls (for example more than two alleles) but never miss one
+HET_GT = re.compile(r"\t([\d.]+)[/|](?!\1[:\t\n])[\d.]+")
 
-    for k, v in lineage_variants_count.items():
-        if v <= 8:
-            for var, lin_freqs in lineage_data.items():
-                lineage_data[var] = [(x, y) for x, y in lin_freqs if x != k]
-    lineage_variants_count = {k: v for k, v in lineage_variants_count.items() if v >= 8}
 
-    h = gzip.open(vcf_path, "rt") if vcf_path.endswith(".gz") else open(vcf_path)
+def parse_vcf(vcf_path, min_allele_depth, lineage_data={}, all_sites=False, checkpoint=None,
+              checkpoint_interval=300, resume=False):
+    """Reads a multi sample VCF and returns the per sample data of each position.
+    Only positions with at least one minority variant candidate are kept, unless all_sites is True
+    (needed to build shards, where a position can become variable when new samples are added).
+    If checkpoint is set, the parse state is saved there every checkpoint_interval seconds, and with resume
+    the parse continues from the saved state (see load_checkpoint).
+    Instead of a path, vcf_path can be a stream of VCF lines (bytes), in that case there are no checkpoints.
+    """
+    if isinstance(vcf_path, str):
+        h = gzip.open(vcf_path, "rb") if vcf_path.endswith(".gz") else open(vcf_path, "rb")
+    else:
+        h, vcf_path, checkpoint = vcf_path, "-", None
     number_of_variable_sites = 0
     number_of_mutations = 0
     ns_per_sample = defaultdict(lambda: 0)
     sample_lineages = defaultdict(dict)
+    checkpoint_key = checkpoint and {
+        "vcf": os.path.abspath(vcf_path), "size": os.path.getsize(vcf_path), "mtime": os.path.getmtime(vcf_path),
+        "min_allele_depth": min_allele_depth, "all_sites": all_sites, "lineages": len(lineage_data)}
     try:
         samples = None
         variants = {}
-        for line in tqdm(h):
+        het_samples = {}
+        site_mutations = {}
+        state = load_checkpoint(checkpoint, checkpoint_key) if (checkpoint and resume) else None
+        if state:
+            h.seek(state["offset"])
+            samples, variants, het_samples, site_mutations = (state["samples"], state["variants"],
+                                                              state["het_samples"], state["site_mutations"])
+            ns_per_sample.update(state["ns_per_sample"])
+            sample_lineages.update(state["sample_lineages"])
+            number_of_variable_sites = state["number_of_variable_sites"]
+            number_of_mutations = state["number_of_mutations"]
+            sys.stderr.write(f"resuming {vcf_path} from {number_of_variable_sites} sites\n")
+        last_checkpoint = time.time()
+        for raw_line in tqdm(h):
+            line = raw_line.decode()
+            if checkpoint and time.time() - last_checkpoint >= checkpoint_interval:
+                # saved before parsing the line, so the offset is the one of the line start
+                save_checkpoint(checkpoint, {
+                    "key": checkpoint_key, "offset": h.tell() - len(raw_line), "samples": samples,
+                    "variants": variants, "het_samples": het_samples, "site_mutations": site_mutations,
+                    "ns_per_sample": dict(ns_per_sample), "sample_lineages": dict(sample_lineages),
+                    "number_of_variable_sites": number_of_variable_sites,
+                    "number_of_mutations": number_of_mutations})
+                last_checkpoint = time.time()
             if line.startswith("#CHROM"):
                 samples = line.split()[9:]
 
@@ -177,8 +337,18 @@ def variant_filter(vcf_path, outpath, min_allele_depth,min_coverage,min_freq,bad
 
                 ad_index = ad_index[0]
                 dp_index = dp_index[0]
-                number_of_mutations += len(set(vec[4].split(",")) - set(["*", "N"]))
-                low_freq = False
+                site_mutations[pos] = len(set(vec[4].split(",")) - set(["*", "N"]))
+                number_of_mutations += site_mutations[pos]
+
+                if not (all_sites or variant_lineages) and gt_index == 0 and not HET_GT.search(line):
+                    # no sample can be a minority variant candidate, only its not called samples are needed
+                    if "./." in line:
+                        for sample, call in zip(samples, vec[9:]):
+                            if call == "./." or call.startswith("./.:"):
+                                ns_per_sample[sample] += 1
+                    continue
+
+                pos_het_samples = []
                 pos_data = {}
                 for idx, sample in enumerate(samples):
                     gt = vec[9 + idx].split(":")[gt_index]
@@ -202,19 +372,60 @@ def variant_filter(vcf_path, outpath, min_allele_depth,min_coverage,min_freq,bad
                                             ]
 
                         if ads and min_ad >= min_allele_depth and len(set(gt.replace("|", "/").split("/"))) > 1:
-                            low_freq = True
+                            pos_het_samples.append(sample)
 
                         if variant_lineages:
                             sample_lineages[sample][lineage_variant_key] = variant_lineages
 
-                if low_freq:
+                if pos_het_samples or all_sites:
                     variants[pos] = pos_data
+                    het_samples[pos] = pos_het_samples
 
     finally:
         h.close()
 
-    variants = dict(variants)
-    ns_per_sample = dict(ns_per_sample)
+    return {"samples": samples, "variants": variants, "het_samples": het_samples, "site_mutations": site_mutations,
+            "ns_per_sample": dict(ns_per_sample), "sample_lineages": sample_lineages,
+            "number_of_variable_sites": number_of_variable_sites, "number_of_mutations": number_of_mutations}
+
+
+def save_checkpoint(checkpoint, state):
+    # pickle keeps the exact parse state (int positions, tuples), so a resumed run gives the same output.
+    # It is written to a temporary file first, so a crash while saving keeps the previous checkpoint
+    with open(checkpoint + ".tmp", "wb") as h:
+        pickle.dump(state, h, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+def load_checkpoint(checkpoint, key):
+    """Returns the parse state saved in checkpoint, or None if there is no checkpoint or if it belongs to
+    another VCF (path, size and modification time) or to other parameters"""
+    if not os.path.exists(checkpoint):
+        sys.stderr.write(f"'{checkpoint}' not found, starting from the beginning\n")
+        return None
+    with open(checkpoint, "rb") as h:
+        state = pickle.load(h)
+    if state["key"] != key:
+        sys.stderr.write(f"'{checkpoint}' was created with another VCF or parameters, starting from the beginning\n")
+        return None
+    return state
+
+
+def filter_lineage_data(lineage_data):
+    """Removes lineages with too few defining variants. Returns the variant count of the remaining ones"""
+    lineage_variants_count = defaultdict(lambda: 0)
+    for lineajes in lineage_data.values():
+        for lin, _ in lineajes:
+            lineage_variants_count[lin] += 1
+
+    for k, v in lineage_variants_count.items():
+        if v <= 8:
+            for var, lin_freqs in lineage_data.items():
+                lineage_data[var] = [(x, y) for x, y in lin_freqs if x != k]
+    return {k: v for k, v in lineage_variants_count.items() if v >= 8}
+
+
+def summarize_sample_lineages(sample_lineages, lineage_variants_count):
     sample_lineages2 = {}
     for sample, lineage_sample_data in sample_lineages.items():
         lineages_count = defaultdict(lambda: 0)
@@ -228,7 +439,118 @@ def variant_filter(vcf_path, outpath, min_allele_depth,min_coverage,min_freq,bad
              ], key=lambda x: x[2], reverse=True)
         sample_lineages2[sample] = [y for y in sample_lineages2[sample] if
                                     round(y[1] * 1.0 / lineage_variants_count[y[0]], 2) > 0.8]
+    return sample_lineages2
+
+
+def sample_entry(pos, gts, ads, ref, ann, min_allele_depth, min_freq, sample_lineages, sample_lineages2,
+                 qvalue=None, max_fdr=0.05):
+    """Classifies the alleles of one sample in a position.
+    sample_lineages and sample_lineages2 are the ones of the sample.
+    If the q-value of the minority allele is given (see isnv_qvalues), it is used instead of min_freq: the minority
+    variant is kept if qvalue <= max_fdr, and the q-value is stored with it.
+    Returns [is_n, entry, min_variant_key, min_freq, consensus_freq, discarded_ads], where entry is the
+    "entries_data" record and the rest is the contribution of the sample to the cohort stats (None if it does not
+    contribute).
+    """
+    gene, gene_nt, gene_aa = ann
+    min_variant_key = None
+    low_freq = None
+    high_freq = None
+    discarded = None
+    if len(gts) > 1 and sum(ads.values()):
+        depth = sum(ads.values())
+        freqs = [(k, 1 * v / depth) for k, v in sorted(ads.items(), key=lambda x: x[1])]
+        min_variant = freqs[-2]
+        dp = sum(ads.values())
+        minor_allele_depth = [v for k, v in sorted(ads.items(), key=lambda x: x[1], reverse=True)][1]
+        consensus_variant = freqs[-1]
+        if qvalue is None:
+            significant = min_variant[1] >= min_freq
+        else:
+            significant = qvalue <= max_fdr
+        if significant and minor_allele_depth >= min_allele_depth:
+            if (dp >= min_allele_depth):
+                min_variant_key = f'{pos}_{ref}_{min_variant[0]}'
+                if qvalue is not None:
+                    min_variant = [min_variant[0], min_variant[1], float(qvalue)]
+                low_freq = freqs[-2][1]
+                high_freq = freqs[-1][1]
+            else:
+                discarded = [pos, ads]
+        else:
+            consensus_variant = sorted(ads.items(), key=lambda x: x[1])[-1][0]
+            min_variant = [""]
+            high_freq = freqs[-1][1]
+    else:
+        consensus_variant = list(gts.items())[0][0]
+        min_variant = [""]
+    lineage_key = gene + ":" + gene_aa
+
+    if lineage_key in sample_lineages:
+        lineages = [(lineage, lfreq) for lineage, lfreq in sample_lineages[lineage_key]
+                    if lineage in [x[0] for x in sample_lineages2]]
+    else:
+        lineages = []
+
+    entry = [consensus_variant, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa), lineages]
+    return [1 if "N" in gts else 0, entry, min_variant_key, low_freq, high_freq, discarded]
+
+
+FREQ_BINS = 1000
+FREQ_SUM_UNITS = 10 ** 9
 
+
+def freq_histogram():
+    """Fixed resolution (1/FREQ_BINS) histogram of allele frequencies. It has a constant size no matter how many
+    frequencies are added, and histograms of different runs can be merged with merge_histograms.
+    The sum of the frequencies is an integer in 1/FREQ_SUM_UNITS units, so merges do not depend on their order"""
+    return {"bins": FREQ_BINS, "counts": [0] * FREQ_BINS, "sum": 0}
+
+
+def add_freq(hist, freq):
+    hist["counts"][min(int(freq * hist["bins"]), hist["bins"] - 1)] += 1
+    hist["sum"] += round(freq * FREQ_SUM_UNITS)
+
+
+def merge_histograms(*hists, sign=1):
+    """Sum of the histograms. With sign=-1 the rest of the histograms are subtracted from the first one"""
+    assert len(set([hist["bins"] for hist in hists])) == 1, "histograms with different resolution"
+    signs = [1] + [sign] * (len(hists) - 1)
+    return {"bins": hists[0]["bins"],
+            "counts": [sum([x * y for x, y in zip(signs, counts)]) for counts in zip(*[x["counts"] for x in hists])],
+            "sum": sum([x * hist["sum"] for x, hist in zip(signs, hists)])}
+
+
+def add_entry_freqs(low_freq_hist, high_freq_hist, entry):
+    """Adds the minority and consensus frequencies of a sample_entry to the histograms"""
+    _, _, min_variant_key, low_freq, high_freq, _ = entry
+    if min_variant_key:
+        add_freq(low_freq_hist, low_freq)
+    if high_freq is not None:
+        add_freq(high_freq_hist, high_freq)
+
+
+def histogram_stats(hist, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """Count, mean and quantiles of a frequency histogram. Quantiles are the center of the bin where they fall"""
+    counts = np.array(hist["counts"])
+    n = int(counts.sum())
+    stats = {"n": n, "mean": round(hist["sum"] / FREQ_SUM_UNITS / n, 4) if n else None}
+    cumulative = np.cumsum(counts)
+    for q in quantiles:
+        idx = int(np.searchsorted(cumulative, q * n)) if n else None
+        stats[f"q{int(q * 100):02d}"] = round((idx + 0.5) / hist["bins"], 4) if n else None
+    return stats
+
+
+def isnvs_data(samples, positions, pos_ns, position_entries, ns_per_sample, sample_lineages2, min_coverage,
+               badq_strain_ns_threshold, number_of_variable_sites, number_of_mutations, histograms=None):
+    """Builds the "iSNVs" output from the per sample partial results.
+    positions: positions with at least one minority variant candidate, in output order
+    pos_ns: number of samples with an N in each position
+    position_entries: function that given a position returns the (sample, sample_entry) pairs of that position
+    histograms: minority and consensus frequency histograms of the positions that are not excluded, if they are
+    already known (see shards_isnvs_data). Otherwise they are built from position_entries
+    """
     badqualitysamples = {s: v for s, v in ns_per_sample.items() if v > badq_strain_ns_threshold}
     print(f"Number of samples: {len(samples)}")
     print(f'Number of bad quality samples: {len(badqualitysamples)}')
@@ -236,91 +558,275 @@ def variant_filter(vcf_path, outpath, min_allele_depth,min_coverage,min_freq,bad
     print(f'number of mutations: {number_of_mutations}')
 
     excluded_positions = []
-    low_freq_freq = []
-    high_freq_freq = []
-    # low_freq_pos = []
-    low_freq_muts = []
+    low_freq_hist, high_freq_hist = histograms or (freq_histogram(), freq_histogram())
     entries_data = {}
 
-    for pos, samples_variants in variants.items():
-        ns = 0
-        for sample, (gts, ads, ref, ann) in samples_variants.items():
-            is_n = (1 if "N" in gts else 0)
-            ns += is_n
-
-        if (1 - (1.0 * ns / len(samples))) < min_coverage:
+    for pos in positions:
+        if (1 - (1.0 * pos_ns[pos] / len(samples))) < min_coverage:
             excluded_positions.append(pos)
-            #     if not is_n:
-            #         low_freq_muts.append(low_freq_mut)
-            #         low_freq_freq += min_freqs
-            #         high_freq_freq += consensus_freqs
-            # else:
 
     print(f'excluded positions( Ns count greater than threashold):{len(excluded_positions)}')
+    excluded = set(excluded_positions)
     discarded_low_depth = defaultdict(list)
     variant_samples = defaultdict(list)
-    for pos, samples_variants in variants.items():
-
-        variant_samples_pos = defaultdict(list)
-        if pos not in excluded_positions:
-            min_freqs = []
-            consensus_freqs = []
+    for pos in positions:
+        if pos not in excluded:
+            variant_samples_pos = defaultdict(list)
             entries = {}
-            valid_min_variant = False
-            for sample, (gts, ads, ref, (gene, gene_nt, gene_aa)) in samples_variants.items():
-
-                if len(gts) > 1:
-                    depth = sum(ads.values())
-                    freqs = [(k, 1 * v / depth) for k, v in sorted(ads.items(), key=lambda x: x[1])]
-                    min_variant = freqs[-2]
-                    dp = sum(ads.values())
-                    minor_allele_depth = [v for k, v in sorted(ads.items(), key=lambda x: x[1], reverse=True)][1]
-                    if min_variant[1] >= min_freq and minor_allele_depth >= min_allele_depth:
-                        if (dp >= min_allele_depth):
-                            min_freqs.append(min_variant[1])
-                            consensus_variant = freqs[-1]
-                            consensus_freqs.append(min_variant[1])
-                            low_freq_mut = [pos, min_freqs]
-                            variant_samples_pos[f'{pos}_{ref}_{min_variant[0]}'].append(sample)
-                            valid_min_variant = True
-                            low_freq_freq.append(freqs[-2][1])
-                            high_freq_freq.append(freqs[-1][1])
-                        else:
-                            discarded_low_depth[sample].append([pos, ads])
-                    else:
-                        consensus_variant = sorted(ads.items(), key=lambda x: x[1])[-1][0]
-                        min_variant = [""]
-                        high_freq_freq.append(freqs[-1][1])
-                else:
-                    consensus_variant = list(gts.items())[0][0]
-                    min_variant = [""]
-                lineage_key = gene + ":" + gene_aa
-
-                if (sample in sample_lineages) and (lineage_key in sample_lineages[sample]):
-                    lineages = [(lineage, lfreq) for lineage, lfreq in sample_lineages[sample][lineage_key]
-                                if lineage in [x[0] for x in sample_lineages2[sample]]]
-                else:
-                    lineages = []
-
-                entries[sample] = [consensus_variant, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa), lineages]
-            if valid_min_variant:
+            for sample, sample_data in position_entries(pos):
+                _, entry, min_variant_key, low_freq, high_freq, discarded = sample_data
+                if min_variant_key:
+                    variant_samples_pos[min_variant_key].append(sample)
+                if not histograms:
+                    add_entry_freqs(low_freq_hist, high_freq_hist, sample_data)
+                if discarded:
+                    discarded_low_depth[sample].append(discarded)
+                entries[sample] = entry
+            if variant_samples_pos:
                 entries_data[pos] = entries
                 for k, v in variant_samples_pos.items():
                     variant_samples[k] = v
 
     print(f'low freq positions:{len(entries_data)}')
     print(f'low freq mutations:{len(variant_samples)}')
+    print(f'minority variants frequency: {histogram_stats(low_freq_hist)}')
+    print(f'consensus variants frequency: {histogram_stats(high_freq_hist)}')
+
+    return {"variant_samples": dict(variant_samples), "entries_data": entries_data,
+            "discarded_low_depth": discarded_low_depth,
+            "excluded_positions": excluded_positions, "low_freq_hist": low_freq_hist,
+            "high_freq_hist": high_freq_hist, "badquality_samples": badqualitysamples,
+            "sample_lineages": sample_lineages2}
+
+
+def bh_adjust(pvalues):
+    """Benjamini-Hochberg adjusted p-values (q-values)"""
+    m = len(pvalues)
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * m / np.arange(1, m + 1)
+    qvalues = np.empty(m)
+    qvalues[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return qvalues
+
+
+def isnv_qvalues(variants, error_rate=0.01, test="binomial", overdispersion=0.01):
+    """Tests the minority allele of every heterozygous call of the cohort against sequencing errors.
+    The p-value is the probability of the minority allele depth or more, given the depth of the call and the
+    error_rate, with a binomial or a beta-binomial distribution (overdispersion is its intra class correlation, with
+    0 it is the binomial one).
+    P-values are adjusted with Benjamini-Hochberg over all the calls of the cohort.
+    variants is the one of parse_vcf. Returns {(pos, sample): qvalue} and the number of tests"""
+    from scipy import stats
+
+    calls = [(pos, sample, list(ads.values())) for pos, samples_variants in variants.items()
+             for sample, (gts, ads, ref, ann) in samples_variants.items() if len(gts) > 1 and sum(ads.values())]
+    if not calls:
+        return {}, 0
+    sizes = np.array([len(x[2]) for x in calls])
+    depths = np.fromiter((d for x in calls for d in x[2]), dtype=np.int64, count=sizes.sum())
+    groups = np.repeat(np.arange(len(calls)), sizes)
+    starts = np.cumsum(sizes) - sizes
+    # second highest depth of each call (0 if it has only one allele)
+    ordered = depths[np.lexsort((-depths, groups))]
+    minor_depth = np.where(sizes > 1, ordered[np.minimum(starts + 1, len(ordered) - 1)], 0)
+    total_depth = np.add.reduceat(depths, starts)
+
+    if test == "betabinomial" and overdispersion > 0:
+        a = error_rate * (1 / overdispersion - 1)
+        b = (1 - error_rate) * (1 / overdispersion - 1)
+        pvalues = stats.betabinom.sf(minor_depth - 1, total_depth, a, b)
+    else:
+        pvalues = stats.binom.sf(minor_depth - 1, total_depth, error_rate)
+    qvalues = bh_adjust(pvalues)
+    return {(pos, sample): q for (pos, sample, _), q in zip(calls, qvalues.tolist())}, len(calls)
+
+
+def variant_filter(vcf_path, outpath, min_allele_depth, min_coverage, min_freq, badq_strain_ns_threshold,
+                   lineage_data={}, shards_dir=None, resume=False, checkpoint_interval=300, isnv_test=None,
+                   error_rate=0.01, overdispersion=0.01, max_fdr=0.05):
+    """MN996528.1	1879	.	A	G	14552.79	.	AC=2;AF=5.556e-03;AN=360;BaseQRankSum=2.16;DP=113297;ExcessHet=0.0061;FS=0.838;InbreedingCoeff=0.8880;MLEAC=2;MLEAF=5.556e-03;MQ=59.99;MQRankSum=0.00;QD=28.76;ReadPosRankSum=1.03;SOR=0.597	GT:AD:DP:GQ:PGT:PID:PL:PS	0/0:717,0:717:99:.:.:0,120,1800	0/0:166,0:166:99:.:.:0,120,1800	0/0:395,0:395:99:.:.:0,120,1800	0/0:354,0:354:99:.:.:0,120,1800	0/0:464,0:464:99:.:.:0,120,1800	0/0:363,0:363:99:.:.:0,120,1800	0/0:464,0:464:99:.:.:0,120,1800	0/0:396,0:396:99:.:.:0,120,1800	0/0:288,0:288:99:.:.:0,120,1800	0/0:371,0:371:99:.:.:0,120,1800	0/0:347,0:347:99:.:.:0,120,1800	0/0:422,0:422:99:.:.:0,120,1800	0/0:517,0:517:99:.:.:0,120,1800	0/0:392,0:392:99:.:.:0,120,1800	0/0:392,0:392:99:.:.:0,120,1800	0/0:465,0:465:99:.:.:0,120,1800
+
+    vcf_path can also be a stream of VCF lines (see parse_vcf).
+    If shards_dir is set, per sample partial results are stored there and the VCF samples are added to the
+    ones already in it (see update_shards).
+    While the VCF is parsed, its state is saved every checkpoint_interval seconds in "{outpath}.checkpoint" (0 disables
+    it). With resume, the parse continues from there. The checkpoint is removed when the output is written.
+    With isnv_test ("binomial" or "betabinomial") minority variants are selected by their q-value instead of
+    min_freq (see isnv_qvalues). It can not be used with shards_dir, since q-values depend on the whole cohort.
+        """
+    if isinstance(vcf_path, str) and not os.path.exists(vcf_path):
+        sys.stderr.write(f"'{vcf_path}' does not exists\n")
+        sys.exit(1)
+    if isnv_test and shards_dir:
+        sys.stderr.write("the statistical test can not be used with shards, q-values depend on the whole cohort\n")
+        sys.exit(1)
+    if isnv_test and not 0 < error_rate < 1:
+        sys.stderr.write(f"the error rate must be between 0 and 1 (not included), not {error_rate}\n")
+        sys.exit(1)
+    if isnv_test and not 0 <= overdispersion < 1:
+        sys.stderr.write(f"the overdispersion must be between 0 (binomial test) and 1 (not included), "
+                         f"not {overdispersion}\n")
+        sys.exit(1)
 
-    variant_samples = dict(variant_samples)
-    entries_data = dict(entries_data)
+    print(f"Running lowfreq variant detection with:")
+    print(f'- Minimun allele read depth: {min_allele_depth}')
+    print(f'- max %N to discard a position: {min_coverage}')
+    if isnv_test:
+        print(f'- {isnv_test} test, error rate: {error_rate}, max FDR: {max_fdr}')
+    else:
+        print(f'- minimun minority variant frequency: {min_freq}')
+    print("----------------")
+
+    lineage_variants_count = filter_lineage_data(lineage_data)
+    checkpoint = f"{outpath}.checkpoint" if checkpoint_interval else None
+    checkpoint_params = {"checkpoint": checkpoint, "checkpoint_interval": checkpoint_interval, "resume": resume}
+
+    if shards_dir:
+        update_shards(shards_dir, vcf_path, min_allele_depth, min_freq, lineage_data, lineage_variants_count,
+                      checkpoint_params)
+        data = shards_isnvs_data(shards_dir, min_coverage, badq_strain_ns_threshold)
+    else:
+        vcf_data = parse_vcf(vcf_path, min_allele_depth, lineage_data, **checkpoint_params)
+        variants = vcf_data["variants"]
+        sample_lineages = vcf_data["sample_lineages"]
+        sample_lineages2 = summarize_sample_lineages(sample_lineages, lineage_variants_count)
+        pos_ns = {pos: sum([1 if "N" in gts else 0 for gts, ads, ref, ann in samples_variants.values()])
+                  for pos, samples_variants in variants.items()}
+        qvalues = {}
+        if isnv_test:
+            qvalues, tests = isnv_qvalues(variants, error_rate, isnv_test, overdispersion)
+            print(f'tested minority variants: {tests}, significant: {sum(q <= max_fdr for q in qvalues.values())}')
+
+        def position_entries(pos):
+            for sample, (gts, ads, ref, ann) in variants[pos].items():
+                yield sample, sample_entry(pos, gts, ads, ref, ann, min_allele_depth, min_freq,
+                                           sample_lineages.get(sample, {}), sample_lineages2.get(sample, []),
+                                           qvalues.get((pos, sample)), max_fdr)
+
+        data = isnvs_data(vcf_data["samples"], list(variants), pos_ns, position_entries,
+                          vcf_data["ns_per_sample"], sample_lineages2, min_coverage, badq_strain_ns_threshold,
+                          vcf_data["number_of_variable_sites"], vcf_data["number_of_mutations"])
 
     with open(f"{outpath}", "w") as h:
-        data = {"variant_samples": variant_samples, "entries_data": entries_data,
-                "discarded_low_depth": discarded_low_depth,
-                "excluded_positions": excluded_positions, "low_freq_freq": low_freq_freq,
-                "high_freq_freq": high_freq_freq, "badquality_samples": badqualitysamples,
-                "sample_lineages": sample_lineages2}
         json.dump(data, h)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def update_shards(shards_dir, vcf_path, min_allele_depth, min_freq, lineage_data, lineage_variants_count,
+                  checkpoint_params={}):
+    """Adds the samples of a VCF to a shards directory.
+    The samples of each VCF are stored in their own shard (batches/N.jsonl) with their sample_entry of every
+    position where they have read depth, one line per position, so the samples already in the cohort are never
+    parsed again and only the lines of the reported positions are read (see shards_isnvs_data).
+    cohort.json keeps the cohort level counts that are updated incrementally: number of Ns and number of
+    minority variant candidates per position, Ns per sample, and the positions of each shard with the offsets of
+    their lines and its frequency histograms.
+    A sample is treated as not called ("./.") in the positions that are not present in its VCF.
+    """
+    cohort_file = f'{shards_dir}/cohort.json'
+    params = {"min_allele_depth": min_allele_depth, "min_freq": min_freq}
+    if os.path.exists(cohort_file):
+        with open(cohort_file) as h:
+            cohort = json.load(h)
+        if cohort["params"] != params:
+            sys.stderr.write(f"'{shards_dir}' was built with {cohort['params']}, "
+                             f"use a new shards directory for {params}\n")
+            sys.exit(1)
+    else:
+        os.makedirs(f'{shards_dir}/batches', exist_ok=True)
+        cohort = {"params": params, "samples": [], "batches": [], "sites": {}, "ns_per_sample": {},
+                  "sample_lineages": {}}
+
+    vcf_data = parse_vcf(vcf_path, min_allele_depth, lineage_data, all_sites=True, **checkpoint_params)
+    new_samples = vcf_data["samples"]
+    repeated = set(new_samples) & set(cohort["samples"])
+    if repeated:
+        sys.stderr.write(f"samples already in '{shards_dir}': {', '.join(sorted(repeated))}\n")
+        sys.exit(1)
+
+    sample_lineages = vcf_data["sample_lineages"]
+    sample_lineages2 = summarize_sample_lineages(sample_lineages, lineage_variants_count)
+    batch = {"samples": new_samples, "sites": list(vcf_data["variants"]), "offsets": [], "freq_sites": [],
+             "low_freq_hist": freq_histogram(), "high_freq_hist": freq_histogram()}
+    offset = 0
+    with open(f'{shards_dir}/batches/{len(cohort["batches"])}.jsonl', "wb") as h:
+        for pos, samples_variants in vcf_data["variants"].items():
+            site = cohort["sites"].setdefault(str(pos), {"ns": 0, "het": 0,
+                                                         "mutations": vcf_data["site_mutations"][pos]})
+            site["het"] += len(vcf_data["het_samples"][pos])
+            entries = {}
+            for sample, (gts, ads, ref, ann) in samples_variants.items():
+                entry = sample_entry(pos, gts, ads, ref, ann, min_allele_depth, min_freq,
+                                     sample_lineages.get(sample, {}), sample_lineages2.get(sample, []))
+                site["ns"] += entry[0]
+                entries[sample] = entry
+                if entry[2] or entry[4] is not None:
+                    add_entry_freqs(batch["low_freq_hist"], batch["high_freq_hist"], entry)
+                    if not batch["freq_sites"] or batch["freq_sites"][-1] != pos:
+                        batch["freq_sites"].append(pos)
+            line = (json.dumps(entries) + "\n").encode()
+            batch["offsets"].append(offset)
+            offset += len(line)
+            h.write(line)
+
+    cohort["samples"] += new_samples
+    cohort["batches"].append(batch)
+    cohort["ns_per_sample"].update({s: vcf_data["ns_per_sample"].get(s, 0) for s in new_samples})
+    cohort["sample_lineages"].update(sample_lineages2)
+    with open(cohort_file, "w") as h:
+        json.dump(cohort, h)
+
+
+def shards_isnvs_data(shards_dir, min_coverage, badq_strain_ns_threshold):
+    """Builds the "iSNVs" output from a shards directory. Only the shards lines of the reported positions are read.
+    The frequency histograms are the merge of the ones of each shard, without the positions that are not reported
+    (excluded, or without minority variant candidates in the whole cohort)"""
+    with open(f'{shards_dir}/cohort.json') as h:
+        cohort = json.load(h)
+    samples = cohort["samples"]
+    positions = sorted([int(pos) for pos, site in cohort["sites"].items() if site["het"]])
+    pos_ns = {pos: cohort["sites"][str(pos)]["ns"] for pos in positions}
+    excluded = set([pos for pos in positions if (1 - (1.0 * pos_ns[pos] / len(samples))) < min_coverage])
+    reported = set(positions) - excluded
+
+    shards = []
+    low_freq_hists, high_freq_hists = [], []
+    for idx, batch in enumerate(cohort["batches"]):
+        offsets = dict(zip(batch["sites"], batch["offsets"]))
+        not_reported = [pos for pos in batch["freq_sites"] if pos not in reported]
+        shard = {}
+        with open(f'{shards_dir}/batches/{idx}.jsonl', "rb") as h:
+            for pos in sorted(reported.intersection(offsets)) + not_reported:
+                h.seek(offsets[pos])
+                shard[pos] = json.loads(h.readline())
+        low_freq_hist, high_freq_hist = freq_histogram(), freq_histogram()
+        for pos in not_reported:
+            for entry in shard.pop(pos).values():
+                add_entry_freqs(low_freq_hist, high_freq_hist, entry)
+        low_freq_hists.append(merge_histograms(batch["low_freq_hist"], low_freq_hist, sign=-1))
+        high_freq_hists.append(merge_histograms(batch["high_freq_hist"], high_freq_hist, sign=-1))
+        shards.append((batch["samples"], shard))
+
+    def position_entries(pos):
+        for batch_samples, shard in shards:
+            if pos in shard:
+                for sample in batch_samples:
+                    if sample in shard[pos]:
+                        yield sample, shard[pos][sample]
+
+    all_sites = set(cohort["sites"])
+    ns_per_sample = {}
+    for batch in cohort["batches"]:
+        missing_sites = len(all_sites - set([str(x) for x in batch["sites"]]))
+        for sample in batch["samples"]:
+            if cohort["ns_per_sample"][sample] + missing_sites:
+                ns_per_sample[sample] = cohort["ns_per_sample"][sample] + missing_sites
+
+    return isnvs_data(samples, positions, pos_ns, position_entries, ns_per_sample, cohort["sample_lineages"],
+                      min_coverage, badq_strain_ns_threshold, len(all_sites),
+                      sum([site["mutations"] for site in cohort["sites"].values()]),
+                      (merge_histograms(*low_freq_hists), merge_histograms(*high_freq_hists)))
 
 
 def aln(h, output, refseq=None, included_samples=None):
@@ -379,151 +885,334 @@ def aln(h, output, refseq=None, included_samples=None):
         h.close()
 
 
-def comparative_analysis(json_file, output_dir, min_lowfreq=None,percent_dev=0.95, min_depth=10):
-    assert os.path.exists(json_file), f'"{json_file}" does not exists'
-    with open(json_file) as h:
-        data = json.load(h)
+PLOT_FORMATS = ["png", "eps", "pdf", "svg"]
 
-    min_per_sample = defaultdict(list)
-    pos_data = {}
-
-    variant_samples = defaultdict(dict)
-    min_variant_samples = defaultdict(list)
-    consensus_variant_samples = defaultdict(list)
-    discarded_variant_samples = defaultdict(list)
-    ann_variants = {}
-    all_samples = list(data["entries_data"].items())[0][1].keys()
-    for pos, sample_data in data["entries_data"].items():
-        pos_data[pos] = {"consensus": defaultdict(list), "mins": defaultdict(list)}
-
-        for sample, (
-                consensus_variant_raw, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa),
-                lineages) in sample_data.items():
-            min_var_freq = 0
-            consensus_variant = consensus_variant_raw[0] if len(min_variant) > 1 else consensus_variant_raw
-            ads_filtered = {k:v for k,v in ads.items() if v >= min_depth}
-            for allele in ads.keys():
-                if (allele in gts) and ads[allele]:
-                    var_str = f'{pos}_{ref}_{allele}'
-                    #ads_filtered = {k:v for k,v in ads.items() if v > min_depth}
-                    if ads_filtered and (allele in ads_filtered):
-                        if allele and (allele in [consensus_variant,min_variant[0]]):
-                            variant_samples[var_str][sample] = ads_filtered
-                        else:
-                            discarded_variant_samples[var_str].append(sample)
+
+def plot_min_variants_count(plot_data, output_file, fmt):
+    plt.figure(figsize=(15, 10))
+    ax = plt.subplot()
+    ax.axvline(plot_data["cutoff"], 0, max(plot_data["counts"]), color="red")
+    plt.xlabel("Low freq variants count", fontsize=18)
+    plt.ylabel("Samples count", fontsize=18)
+
+    numbers, counts = list(zip(*Counter([x for x in plot_data["sample_counts"] if x]).items()))
+    plt.bar(numbers, counts)
+    ax.plot(plot_data["counts"], [0.01] * len(plot_data["counts"]), '|', color='k')
+    plt.savefig(output_file, format=fmt)
+    plt.close()
 
 
-            if ads_filtered and consensus_variant in ads_filtered:
-                consensus_variant_samples[f'{pos}_{ref}_{consensus_variant}'].append(sample)
+def plot_min_variants_count_with_0(plot_data, output_file, fmt):
+    plt.figure()
+    numbers, counts = list(zip(*Counter(plot_data["sample_counts"]).items()))
+    plt.bar(numbers, counts)
+    plt.savefig(output_file, format=fmt)
+    plt.close()
 
-            if min_variant and min_variant[0] and (ads[min_variant[0]] >= min_depth):
-                min_var_mut = f'{pos}_{ref}_{min_variant[0]}'
-                min_variant_samples[min_var_mut].append(sample)
-                ann_variants[min_var_mut] = (gene + ":" + gene_aa) if ref != min_variant[0] else ""
 
-                min_var_freq = min_variant[1]
-                min_per_sample[sample].append(min_var_mut)
+def plot_candidates_freqs(plot_data, output_file, fmt):
+    plt.figure(figsize=(15, 10))
+    plt.xlabel("Samples", fontsize=18)
+    plt.ylabel("Min Variants Freqs", fontsize=18)
+    plt.xticks(rotation=90)
+    plt.boxplot(x=plot_data["freqs"], labels=plot_data["candidates"])
+    plt.savefig(output_file, format=fmt)
+    plt.close()
 
-                pos_data[pos]["mins"][min_var_mut].append(min_var_freq)
 
-            pos_data[pos]["consensus"][consensus_variant].append(1 - min_var_freq)
-    min_per_sample = dict(min_per_sample)
+def plot_freq_histograms(plot_data, output_file, fmt, plot_bins=50):
+    """Plots the minority and consensus variant frequency distributions of the "iSNVs" step"""
+    plt.figure(figsize=(15, 10))
+    plt.xlabel("Variant frequency", fontsize=18)
+    plt.ylabel("Variants count", fontsize=18)
+    for hist, label in [(plot_data["low_freq_hist"], "minority variants"),
+                        (plot_data["high_freq_hist"], "consensus variants")]:
+        assert hist["bins"] % plot_bins == 0, f"{hist['bins']} bins can not be grouped in {plot_bins}"
+        counts = np.array(hist["counts"]).reshape(plot_bins, -1).sum(axis=1)
+        plt.stairs(counts, np.linspace(0, 1, plot_bins + 1), label=label)
+    plt.legend()
+    plt.savefig(output_file, format=fmt)
+    plt.close()
 
-    df = pd.DataFrame([{"sample": k, "count": len(v)} for k, v in min_per_sample.items()])
 
+# figure name -> (function, key of its data in plots_data.json)
+PLOTS = {
+    "min_variants_count_per_sample": (plot_min_variants_count, "min_variants_count"),
+    "min_variants_count_per_sample_with_0": (plot_min_variants_count_with_0, "min_variants_count"),
+    "isnvs_freqs": (plot_freq_histograms, "isnvs_freqs"),
+    "candidates_freqs": (plot_candidates_freqs, "candidates_freqs"),
+}
+
+
+def render_plot(task):
+    name, plot_data, output_file, fmt = task
+    PLOTS[name][0](plot_data, output_file, fmt)
+    return output_file
+
+
+def render_plots(plots_data, output_dir, formats=("png", "eps"), processes=None):
+    """Renders the figures of the "candidates" step from its summary data (plots_data.json).
+    Each figure and format is rendered in its own worker process."""
+    if "none" in formats:
+        return []
+    tasks = [(name, plots_data[data_key], f'{output_dir}/{name}.{fmt}', fmt)
+             for name, (_, data_key) in PLOTS.items() if plots_data.get(data_key)
+             for fmt in formats]
+    if not tasks:
+        return []
+    if processes == 1:
+        return [render_plot(task) for task in tasks]
+    with Pool(processes) as pool:
+        return pool.map(render_plot, tasks, chunksize=1)
+
+
+def long_format_entries(entries_data):
+    """Flattens the "entries_data" of the "iSNVs" step in three tables:
+    - positions: annotation of each position (taken from its last sample, as in the candidate reports)
+    - samples: one row per position and sample, with its consensus and minority variant. consensus_aln is the
+      first element of the stored consensus, as used in the candidate reports
+    - alleles: one row per position, sample and allele (long format) with its depth and role
+      (consensus, min or other). Only alleles of the called genotype, and the consensus, are included
+    """
+    positions_rows = []
+    samples_rows = []
+    alleles_rows = []
+    for pos, sample_data in entries_data.items():
+        _, _, _, _, ref, (gene, gene_nt, gene_aa), lineages = next(reversed(sample_data.values()))
+        positions_rows.append((pos, int(pos), ref, gene, gene_nt, gene_aa,
+                               " ".join([x[0] + "|" + str(round(x[1], 2)) for x in lineages])))
+        for sample, (consensus_variant_raw, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa),
+                     lineages) in sample_data.items():
+            consensus_variant = consensus_variant_raw[0] if len(min_variant) > 1 else consensus_variant_raw
+            # first element of the stored consensus is the one used to compare samples in the candidates report
+            if len(min_variant) > 1 and min_variant[0]:
+                min_allele = min_variant[0]
+                samples_rows.append((
+                    pos, sample, ref, consensus_variant_raw[0], min_allele, f'{pos}_{ref}_{min_allele}',
+                    min_variant[1], sum(ads.values()), ads[min_allele],
+                    "_".join([sample, str(ads[min_allele]), str(round(min_variant[1], 2))]),
+                    (gene + ":" + gene_aa) if ref != min_allele else "", consensus_variant))
+            else:
+                min_allele = ""
+                samples_rows.append((pos, sample, ref, consensus_variant_raw[0], "", "", 0, 0, 0, "", "",
+                                     consensus_variant))
+
+            if len(gts) == 1 and consensus_variant in gts:
+                if consensus_variant in ads:
+                    alleles_rows.append((pos, sample, consensus_variant, f'{pos}_{ref}_{consensus_variant}',
+                                         ads[consensus_variant], "consensus", True))
+            else:
+                for allele, depth in ads.items():
+                    if allele == consensus_variant:
+                        alleles_rows.append((pos, sample, allele, f'{pos}_{ref}_{allele}', depth, "consensus",
+                                             allele in gts))
+                    elif allele in gts:
+                        alleles_rows.append((pos, sample, allele, f'{pos}_{ref}_{allele}', depth,
+                                             "min" if allele == min_allele else "other", True))
+
+    positions_df = pd.DataFrame.from_records(positions_rows, columns=[
+        "pos", "pos_num", "ref", "gene", "gene_nt", "gene_aa", "lineages"]).set_index("pos")
+    samples_df = pd.DataFrame.from_records(samples_rows, columns=[
+        "pos", "sample", "ref", "consensus_aln", "allele_min", "min_variant", "freq_min", "depth", "depth_min",
+        "min_label", "ann", "consensus"])
+    alleles_df = pd.DataFrame.from_records(alleles_rows, columns=[
+        "pos", "sample", "allele", "variant", "depth", "role", "in_gt"])
+    return positions_df, samples_df, alleles_df
+
+
+def select_candidates(min_counts, min_lowfreq=None, percent_dev=0.95):
+    """Samples with more minority variants (min_counts, per sample) than the cutoff. The cutoff is min_lowfreq or,
+    if it is not set, the percent_dev quantile of a poisson with the mean number of minority variants.
+    Returns the cutoff and the candidates"""
     if min_lowfreq:
-        sys.stderr.write(f"using min_lowfreq method to select candidates. cutoff:  {min_lowfreq} \n")
         cutoff = min_lowfreq
     else:
-
-        # median = np.mean(df["count"])
-        # deviation = np.std(df["count"])
+        # median = np.mean(min_counts)
+        # deviation = np.std(min_counts)
         # cutoff = median + deviation_lowfreq * deviation
 
         from scipy.stats import poisson
-        cutoff = poisson.ppf(percent_dev, np.mean(df["count"]))
+        cutoff = poisson.ppf(percent_dev, np.mean(min_counts))
+    return cutoff, list(min_counts[min_counts > cutoff].index)
+
+
+def pack_bits(matrix):
+    """Rows of a boolean matrix as bitsets of 64 bit words"""
+    packed = np.packbits(matrix, axis=-1)
+    packed = np.pad(packed, [(0, 0)] * (packed.ndim - 1) + [(0, -packed.shape[-1] % 8)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def popcount(bits):
+    """Number of set bits of each bitset (last axis) of pack_bits words"""
+    bits = bits - ((bits >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    bits = (bits & np.uint64(0x3333333333333333)) + ((bits >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    bits = (bits + (bits >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((bits * np.uint64(0x0101010101010101)) >> np.uint64(56)).sum(axis=-1, dtype=np.int64)
+
+
+def lineage_signatures(lineage_data, keys, min_lineage_freq=0.8):
+    """Lineage signatures as bitsets (pack_bits rows) over keys ("gene:aa" variants, as in lineage_data):
+    the variants found in at least min_lineage_freq of the lineage sequences. Lineages without variants in keys
+    are not included. Returns the lineages and their bitsets"""
+    key_idx = {key: i for i, key in enumerate(keys)}
+    lineages = {}
+    rows, cols = [], []
+    for key, lineage_freqs in lineage_data.items():
+        if key in key_idx:
+            for lineage, freq in lineage_freqs:
+                if freq >= min_lineage_freq:
+                    rows.append(lineages.setdefault(lineage, len(lineages)))
+                    cols.append(key_idx[key])
+    signatures = np.zeros((len(lineages), len(keys)), dtype=bool)
+    signatures[rows, cols] = True
+    return list(lineages), pack_bits(signatures)
+
+
+def lineage_mixtures(samples_df, positions_df, candidates, lineage_data, min_depth=10, min_lineage_freq=0.8,
+                     top_lineages=50, top_pairs=3):
+    """Pairs of lineages that best explain the variants of each candidate (consensus and minority ones).
+    Only the annotated positions of the "iSNVs" output are used. For each candidate the frequency of each variant is
+    1 (or 1 - minority frequency) if it is in the consensus, the minority frequency if it is the minority variant,
+    and 0 if it is not found. Positions where the sample is N are not used.
+    Every lineage is scored with bitset popcounts (see lineage_signatures), and the pairs of the top_lineages that
+    explain more of the sample variants are compared:
+    - explained: sample variants in any of the two lineages
+    - missing: sample variants that are not in the lineages
+    - unexpected: variants of the lineages that are not found in the sample
+    - score: explained / (explained + missing + unexpected)
+    - minor_proportion: estimated from the frequency of the variants exclusive of each lineage (the ones with a
+      minority allele if there are)
+    Returns the top_pairs of each candidate."""
+    columns = ["sample", "rank", "major", "minor", "minor_proportion", "score", "explained", "missing",
+               "unexpected"]
+    annotated = positions_df[positions_df.gene_aa != ""]
+    keys = pd.Index((annotated.gene + ":" + annotated.gene_aa).unique())
+    lineages, signatures = lineage_signatures(lineage_data, keys, min_lineage_freq)
+    if not lineages or not len(candidates):
+        return pd.DataFrame([], columns=columns)
+    unpacked = np.unpackbits(signatures.view(np.uint8), axis=1, count=len(keys)).astype(bool)
+
+    rows = samples_df[samples_df["sample"].isin(candidates) & samples_df.pos.isin(annotated.index)]
+    has_min = (rows.allele_min != "").values & (rows.depth_min >= min_depth).values
+    mutated_consensus = (rows.consensus != rows.ref).values
+    freq = np.where(has_min & (rows.allele_min != rows.ref).values, rows.freq_min.values,
+                    np.where(mutated_consensus, np.where(has_min, 1 - rows.freq_min.values, 1.0), 0.0))
+    sample_idx = pd.Index(candidates).get_indexer(rows["sample"])
+    key_idx = keys.get_indexer(annotated.gene.reindex(rows.pos) + ":" + annotated.gene_aa.reindex(rows.pos))
+    freqs = np.zeros((len(candidates), len(keys)))
+    called = np.zeros((len(candidates), len(keys)), dtype=bool)
+    with_min = np.zeros((len(candidates), len(keys)), dtype=bool)
+    with_min[sample_idx[has_min], key_idx[has_min]] = True
+    # positions with the same variant key keep their highest frequency
+    np.maximum.at(freqs, (sample_idx, key_idx), freq)
+    called[sample_idx[(rows.consensus != "N").values], key_idx[(rows.consensus != "N").values]] = True
+    freqs[~called] = 0
+    observed_bits = pack_bits(freqs > 0)
+    called_bits = pack_bits(called)
+
+    results = []
+    for c, sample in enumerate(candidates):
+        observed = popcount(observed_bits[c])
+        # single lineages, to keep only the ones that explain more variants (and predict less absent ones)
+        explained = popcount(signatures & observed_bits[c])
+        unexpected = popcount(signatures & (called_bits[c] & ~observed_bits[c]))
+        top = np.lexsort((unexpected, -explained))[:top_lineages]
+        # all the pairs of the top lineages at once: union of their signatures
+        union = signatures[top][:, None, :] | signatures[top][None, :, :]
+        pair_explained = popcount(union & observed_bits[c])
+        pair_unexpected = popcount(union & (called_bits[c] & ~observed_bits[c]))
+        score = pair_explained / np.maximum(observed + pair_unexpected, 1)
+        score[np.tril_indices(len(top))] = -1
+        for rank, flat in enumerate(np.argsort(-score, axis=None, kind="stable")[:top_pairs], 1):
+            a, b = np.unravel_index(flat, score.shape)
+            if score[a, b] < 0:
+                break
+            only_a = unpacked[top[a]] & ~unpacked[top[b]] & called[c]
+            only_b = unpacked[top[b]] & ~unpacked[top[a]] & called[c]
+            # proportion of b: frequency of its exclusive variants, and absence of the ones of a. Variants with
+            # a minority allele are preferred, since consensus ones without it are just 1 or 0
+            exclusive = only_a | only_b
+            if (exclusive & with_min[c]).any():
+                exclusive &= with_min[c]
+            estimates = np.where(only_b, freqs[c], 1 - freqs[c])[exclusive]
+            proportion_b = estimates.mean() if len(estimates) else 0.5
+            major, minor = (a, b) if proportion_b <= 0.5 else (b, a)
+            results.append([sample, rank, lineages[top[major]], lineages[top[minor]],
+                            round(min(proportion_b, 1 - proportion_b), 2), round(score[a, b], 3),
+                            pair_explained[a, b], observed - pair_explained[a, b], pair_unexpected[a, b]])
+    return pd.DataFrame(results, columns=columns)
+
+
+def comparative_analysis(json_file, output_dir, min_lowfreq=None,percent_dev=0.95, min_depth=10,
+                         plot_formats=("png", "eps"), processes=None, lineage_data=None, min_lineage_freq=0.8):
+    assert os.path.exists(json_file), f'"{json_file}" does not exists'
+    with open(json_file) as h:
+        data = json.load(h)
+
+    positions_df, samples_df, alleles_df = long_format_entries(data["entries_data"])
+    all_samples = samples_df["sample"].unique()
+
+    # minority variants over the depth cutoff, in the same order they appear in the data
+    mins_df = samples_df[(samples_df.allele_min != "") & (samples_df.depth_min >= min_depth)]
+    min_counts = mins_df.groupby("sample", sort=False).size()
 
+    cutoff, candidates = select_candidates(min_counts, min_lowfreq, percent_dev)
+    if min_lowfreq:
+        sys.stderr.write(f"using min_lowfreq method to select candidates. cutoff:  {min_lowfreq} \n")
+    else:
         # sys.stderr.write(
         #     f"deviation_lowfreq method to select candidates mean {median:.2f} deviation {deviation:.2f} cutoff {cutoff:.2f}\n")
         sys.stderr.write(
             f"deviation_lowfreq method to select candidates 95% percent of data cutoff: {cutoff:.2f} low freq variants   \n ")
 
-    candidates = list(df[df["count"] > cutoff]["sample"])
-
-    sample_min_variants = {sample: [] for sample in all_samples}
-    for variant, samples in min_variant_samples.items():
-        for sample in samples:
-            sample_min_variants[sample].append(variant)
-
-    plt.figure(figsize=(15, 10))
-    ax = plt.subplot()
-    ax.axvline(cutoff, 0, max(df["count"]), color="red")
-    plt.xlabel("Low freq variants count", fontsize=18)
-    plt.ylabel("Samples count", fontsize=18)
-
-    numbers, counts = list(zip(*Counter([len(x) for x in sample_min_variants.values() if x]).items()))
-    plt.bar(numbers, counts)
-    ax.plot(df["count"], [0.01] * len(df["count"]), '|', color='k')
-    plt.savefig(f'{output_dir}/min_variants_count_per_sample.png')
-    plt.savefig(f'{output_dir}/min_variants_count_per_sample.eps', format="eps")
-    plt.close()
-
-    numbers, counts = list(zip(*Counter([len(x) for x in sample_min_variants.values()]).items()))
-    plt.bar(numbers, counts)
-    ax.plot(df["count"], [0.01] * len(df["count"]), '|', color='k')
-    plt.savefig(f'{output_dir}/min_variants_count_per_sample_with_0.png')
-    plt.savefig(f'{output_dir}/min_variants_count_per_sample_with_0.eps', format="eps")
-    plt.close()
-
+    sample_min_variants = min_counts.reindex(all_samples, fill_value=0)
+
+    # position level data, computed once and joined to each candidate variant
+    pos_df = positions_df[["ref", "gene", "gene_nt", "gene_aa", "lineages"]].copy()
+    consensus_counts = samples_df.groupby(["pos", "consensus_aln"], sort=False).size().reset_index(name="count")
+    pos_df["dataset_consensus"] = (consensus_counts.consensus_aln + ":" + consensus_counts["count"].astype(str)
+                                   ).groupby(consensus_counts.pos, sort=False).agg(" ".join)
+
+    # alleles observed in each position: consensus of every sample plus its minority variant
+    observed = pd.concat([
+        samples_df[["pos", "sample", "consensus_aln"]].rename(columns={"consensus_aln": "allele"}),
+        samples_df.loc[samples_df.allele_min != "", ["pos", "sample", "allele_min"]].rename(
+            columns={"allele_min": "allele"})])
+    observed_pos = observed.groupby(["pos", "allele"]).size()
+    observed_sample = observed.groupby(["pos", "sample", "allele"]).size()
+
+    def exclusive(rows, allele_col):
+        """True if the allele is not observed in any other sample of the position"""
+        total = observed_pos.reindex(pd.MultiIndex.from_arrays([rows.pos, rows[allele_col]]),
+                                     fill_value=0).values
+        own = observed_sample.reindex(pd.MultiIndex.from_arrays([rows.pos, rows["sample"], rows[allele_col]]),
+                                      fill_value=0).values
+        return (total - own) == 0
+
+    report_df = mins_df[mins_df["sample"].isin(candidates)]
+    report_df = pd.DataFrame({
+        "sample": report_df["sample"].values,
+        "pos": positions_df.pos_num.reindex(report_df.pos).values,
+        "sample_consensus": report_df.consensus_aln.values,
+        "exclusive_min": exclusive(report_df, "ref"),
+        "exclusive_consensus": exclusive(report_df, "consensus_aln"),
+        "depth": report_df.depth.values,
+        "allele_min": report_df.allele_min.values,
+        "depth_min": report_df.depth_min.values,
+        "freq_min": report_df.freq_min.round(2).values,
+    }).join(pos_df, on=report_df.pos.values)
+    report_df["gene"] = report_df.gene.where(report_df.gene_aa != "", "")
+    report_df["gene_nt"] = report_df.gene_nt.where(report_df.gene_aa != "", "")
+
+    columns = ["pos", "ref", "gene", "gene_nt", "gene_aa", "sample_consensus", "dataset_consensus",
+               "exclusive_min", "exclusive_consensus",
+               "depth", "allele_min", "depth_min", "freq_min",
+               "lineages"]
+    candidate_reports = dict(list(report_df.groupby("sample", sort=False)))
     dfs = {}
-
     for c in candidates:
-        cdata = []
-        for min_var in sorted(min_per_sample[c], key=lambda x: int(x.split("_")[0])):
-            pos = min_var.split("_")[0]
-            aln_consensus = defaultdict(lambda: 0)
-
-            pos_muts = []
-            sample_ads = {}
-            for sample, (consensus_variant, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa), lineages
-                         ) in data["entries_data"][pos].items():
-
-                if sample == c:
-                    consensus = consensus_variant[0]
-                    min_freq = min_variant[1]
-                    min_mut = min_variant[0]
-                    sample_ads = ads
-                else:
-                    pos_muts.append(consensus_variant[0])
-                    if min_variant and min_variant[0]:
-                        pos_muts.append(min_variant[0])
-                aln_consensus[consensus_variant[0]] += 1
-
-            exclusive_minority = bool(set([min_var.split("_")[1]]) - set(pos_muts))
-            exclusive_consensus = bool(set([consensus]) - set(pos_muts))
-            if "n" in aln_consensus:
-                del aln_consensus["N"]
-
-            aln_consensus_str = " ".join([f"{k}:{v}" for k, v in aln_consensus.items()])
-
-            r = {"pos": int(pos), "ref": ref, "sample_consensus": consensus,
-                 "exclusive_consensus": exclusive_consensus,
-                 "exclusive_min": exclusive_minority,
-                 "depth": sum([int(x) for x in sample_ads.values()]), "depth_min": sample_ads[min_mut],
-                 "allele_min": min_mut, "freq_min": np.round(min_freq, 2),
-                 "dataset_consensus": aln_consensus_str,
-                 "gene": gene if gene_aa else "", "gene_nt": gene_nt if gene_aa else "", "gene_aa": gene_aa,
-                 "lineages": " ".join([x[0] + "|" + str(round(x[1], 2)) for x in lineages])
-                 }
-            if sample_ads and (sample_ads[min_mut] >= min_depth):
-                cdata.append(r)
-
-        dfs[c] = pd.DataFrame(cdata,
-                              columns=["pos", "ref", "gene", "gene_nt", "gene_aa", "sample_consensus",
-                                       "dataset_consensus",
-                                       "exclusive_min", "exclusive_consensus",
-                                       "depth", "allele_min", "depth_min", "freq_min",
-                                       "lineages"])
+        dfs[c] = candidate_reports[c].sort_values("pos", kind="stable")[columns].reset_index(drop=True)
 
     # variant_samples[f'{pos}_{allele}'].append(sample)
     summary_df = []
@@ -544,79 +1233,381 @@ def comparative_analysis(json_file, output_dir, min_lowfreq=None,percent_dev=0.9
         }
         df.to_csv(f'{output_dir}/report_{sample_name}.csv', index=False)
         summary_df.append(sample_summary)
-    pd.DataFrame(summary_df)[columns].sort_values("variants").to_csv(f'{output_dir}/candidates_summary.csv',
-                                                                     index=False)
+    summary_df = pd.DataFrame(summary_df, columns=columns)
+    if lineage_data:
+        # pairs of lineages that best explain each candidate (see lineage_mixtures), the best one in the summary
+        mixtures_df = lineage_mixtures(samples_df, positions_df, candidates, lineage_data, min_depth, min_lineage_freq)
+        mixtures_df.to_csv(f'{output_dir}/lineage_mixtures.csv', index=False)
+        best_df = mixtures_df[mixtures_df["rank"] == 1].set_index("sample")[
+            ["major", "minor", "minor_proportion", "score"]].add_prefix("lineage_")
+        summary_df = summary_df.join(best_df, on="sample")
+        columns = columns + list(best_df.columns)
+    summary_df[columns].sort_values("variants").to_csv(f'{output_dir}/candidates_summary.csv', index=False)
     # with open(f'{output_dir}/candidates_summary.csv', "w") as h:
     #         h.write(("\t".join([str(sample_summary[c]) for c in columns]) + "\n"))
 
-    plt.figure(figsize=(15, 10))
-    plt.xlabel("Samples", fontsize=18)
-    plt.ylabel("Min Variants Freqs", fontsize=18)
-    plt.xticks(rotation=90)
-    plt.boxplot(x=[list(dfs[c].freq_min) for c in candidates], labels=candidates)
-    plt.savefig(f'{output_dir}/candidates_freqs.png')
-    plt.savefig(f'{output_dir}/candidates_freqs.eps', format="eps")
-
-    plt.close()
-
     print(f"Report Complete: {len(dfs)} candidate/s were processed")
 
-
+    # alleles of the called genotype with enough depth: kept if they are the consensus or the minority variant
+    called = alleles_df[alleles_df.in_gt & (alleles_df.depth > 0) & (alleles_df.depth >= min_depth)]
+    kept = called[called.role != "other"]
+    variant_samples = kept.groupby("variant", sort=False)["sample"].agg(list)
+    variant_pos = variant_samples.index.str.split("_").str[0].astype(int)
+    variant_samples = variant_samples.iloc[np.argsort(variant_pos, kind="stable")]
+    discarded_counts = called[called.role == "other"].groupby("variant").size()
+    consensus_samples = alleles_df[(alleles_df.role == "consensus") & (alleles_df.depth >= min_depth)].groupby(
+        "variant")["sample"].nunique()
+    lowfreq_counts = mins_df.groupby("min_variant").size()
+    ann_variants = mins_df.drop_duplicates("min_variant", keep="last").set_index("min_variant").ann
+
+    candidates_set = set(candidates)
     with open(f'{output_dir}/variants_list.csv', "w") as h:
         columns = ["variant", "ann", "consensus","discarded", "lowfreq", "in_candidate", "candidate_list"]
         h.write("\t".join(columns) + "\n")
-        for var_str, samples in sorted(variant_samples.items(), key=lambda x: int(x[0].split("_")[0])):
-            allele = var_str.split("_")[2]
-            filtered_samples = [sample for sample,ads in samples.items() if ads.get(allele,0) >= min_depth ]
-            in_candidates = set(filtered_samples)  & set(candidates)
-            consensus = set(consensus_variant_samples[var_str]) #& set(candidates)
-            lowfreq =  min_variant_samples [var_str]
-            if len(filtered_samples) != (len(consensus) + len(lowfreq)):
+        for var_str, filtered_samples in variant_samples.items():
+            # in the order of the data, so the list does not depend on the set ordering
+            in_candidates = [x for x in dict.fromkeys(filtered_samples) if x in candidates_set]
+            consensus = consensus_samples.get(var_str, 0)
+            lowfreq = lowfreq_counts.get(var_str, 0)
+            if len(filtered_samples) != (consensus + lowfreq):
                 print("NO!!!!!!!!!!!!!!!!!!!!")
-            row = {"variant": var_str, "ann": ann_variants[var_str] if var_str in ann_variants else "",
-                   "consensus": len(consensus),
-                   "discarded": len(discarded_variant_samples[var_str]),
-                   #"lowfreq": len([k for k, v in samples.items() if v != 1]),
-                   "lowfreq": len(lowfreq) , #min_variant_samples
+            row = {"variant": var_str, "ann": ann_variants.get(var_str, ""),
+                   "consensus": consensus,
+                   "discarded": discarded_counts.get(var_str, 0),
+                   "lowfreq": lowfreq,
                    "in_candidate": len(in_candidates),
                    "candidate_list": ",".join(in_candidates)}
             h.write(("\t".join([str(row[c]) for c in columns]) + "\n"))
 
+    # minority variants (without depth cutoff) found in samples that are not candidates
+    pos_mins = samples_df[samples_df.allele_min != ""]
+    pos_mins = pos_mins.assign(candidate=pos_mins["sample"].isin(candidates))
+    candidates_labels = pos_mins[pos_mins.candidate].groupby(["pos", "min_variant"], sort=False)["min_label"].agg(
+        list)
+    non_candidates = pos_mins[~pos_mins.candidate].groupby(["pos", "min_variant"], sort=False)["min_label"].agg(
+        list)
     not_candidate_sample_variants = []
-
-    for pos, sample_data in data["entries_data"].items():
-
-        min_variant_samples2 = defaultdict(lambda: defaultdict(list))
-
-        min_var_mut = ""
-        for sample, (
-                consensus_variant, min_variant, gts, ads, ref, (gene, gene_nt, gene_aa),
-                lineages) in sample_data.items():
-
-            # min_ad = [(allele,depth) for allele,depth in sorted(ads.items(),key=lambda x:x[1],reverse=True)   ][1]
-            if min_variant and min_variant[0]:
-                min_var_mut = f'{pos}_{ref}_{min_variant[0]}'
-
-                min_var_freq = round(min_variant[1], 2)
-                if sample not in candidates:
-                    min_variant_samples2[min_var_mut]["non_candidates"].append(
-                        "_".join([sample, str(ads[min_variant[0]]), str(min_var_freq)]))
-                else:
-                    min_variant_samples2[min_var_mut]["candidates"].append(
-                        "_".join([sample, str(ads[min_variant[0]]), str(min_var_freq)]))
-        for key, samples_dict in min_variant_samples2.items():
-            if samples_dict["non_candidates"]:
-                not_candidate_sample_variants.append({"pos": pos, "key": key,
-                                                      "candidates(sample_depth_freq)": samples_dict["candidates"],
-                                                      "non_candidates(sample_depth_freq)": samples_dict[
-                                                          "non_candidates"]
-                                                         , "gene": gene, "gene_nt": gene_nt, "gene_aa": gene_aa})
+    for pos, key in pos_mins[["pos", "min_variant"]].drop_duplicates().itertuples(index=False):
+        if (pos, key) in non_candidates.index:
+            not_candidate_sample_variants.append({"pos": pos, "key": key,
+                                                  "candidates(sample_depth_freq)": candidates_labels.get((pos, key), []),
+                                                  "non_candidates(sample_depth_freq)": non_candidates[(pos, key)],
+                                                  "gene": positions_df.gene[pos],
+                                                  "gene_nt": positions_df.gene_nt[pos],
+                                                  "gene_aa": positions_df.gene_aa[pos]})
 
     pd.DataFrame(not_candidate_sample_variants).to_csv(f'{output_dir}/non_candidate_variants_list.csv', index=False)
 
+    # figures are rendered from this summary data, so they can be rendered again with the "plots" command
+    plots_data = {
+        "min_variants_count": {"cutoff": float(cutoff), "counts": min_counts.tolist(),
+                               "sample_counts": sample_min_variants.tolist()},
+        "isnvs_freqs": {"low_freq_hist": data["low_freq_hist"], "high_freq_hist": data["high_freq_hist"]}
+        if "low_freq_hist" in data else None,
+        "candidates_freqs": {"candidates": candidates, "freqs": [dfs[c].freq_min.tolist() for c in candidates]},
+    }
+    with open(f'{output_dir}/plots_data.json', "w") as h:
+        json.dump(plots_data, h)
+    render_plots(plots_data, output_dir, plot_formats, processes)
+
     return candidates
 
 
+def candidates_cooccurrence(mins_df, candidates, min_similarity=0.5):
+    """Compares the minority variants of every pair of candidates, using a sparse candidates x variants matrix with
+    the frequencies of the minority variants (mins_df, as in comparative_analysis):
+    - shared: minority variants found in both candidates
+    - jaccard: shared / minority variants found in any of them
+    - freq_corr: pearson correlation of the frequencies of the shared variants (at least 2 are needed)
+    Candidates are clustered joining the pairs with jaccard >= min_similarity (connected components).
+    Returns the clusters table, one row per candidate with its most similar one, and the pairs over min_similarity
+    """
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+
+    candidates = pd.Index(candidates)
+    rows = mins_df[mins_df["sample"].isin(candidates)]
+    variant_idx, variants = pd.factorize(rows.min_variant)
+    freqs = sparse.csr_matrix((rows.freq_min.values.astype(float), (candidates.get_indexer(rows["sample"]),
+                                                                      variant_idx)),
+                              shape=(len(candidates), len(variants)))
+    present = sparse.csr_matrix((np.ones(len(freqs.data)), freqs.indices, freqs.indptr), shape=freqs.shape)
+    freqs2 = freqs.multiply(freqs).tocsr()
+    n_variants = np.asarray(present.sum(axis=1)).ravel()
+
+    def canonical(m):
+        # all the products have the same non zero values (pairs with shared variants, and the diagonal), so with
+        # sorted indices their values are aligned
+        m = m.tocsr()
+        m.sort_indices()
+        return m
+
+    shared = canonical(present @ present.T)
+    i, j, n = np.repeat(np.arange(len(candidates)), np.diff(shared.indptr)), shared.indices, shared.data
+    sx = canonical(freqs @ present.T)
+    sxx = canonical(freqs2 @ present.T)
+    # sums of the other candidate frequencies are the transposed ones
+    sx, sy, sxx, syy = sx.data, canonical(sx.T).data, sxx.data, canonical(sxx.T).data
+    sxy = canonical(freqs @ freqs.T).data
+    var_x = np.clip(sxx - sx ** 2 / n, 0, None)
+    var_y = np.clip(syy - sy ** 2 / n, 0, None)
+    # constant frequencies have no correlation (their variance is only float noise, as in np.corrcoef it is NaN)
+    defined = (n > 1) & (var_x * var_y > 1e-16)
+    freq_corr = np.full(len(n), np.nan)
+    freq_corr[defined] = np.clip((sxy - sx * sy / n)[defined] / np.sqrt(var_x * var_y)[defined], -1, 1)
+    jaccard = n / (n_variants[i] + n_variants[j] - n)
+
+    similar = (i < j) & (jaccard >= min_similarity)
+    pairs_df = pd.DataFrame({"sample1": candidates[i[similar]], "sample2": candidates[j[similar]],
+                             "shared": n[similar].astype(int), "jaccard": jaccard[similar].round(3),
+                             "freq_corr": freq_corr[similar].round(3)})
+    graph = sparse.coo_matrix((np.ones(similar.sum()), (i[similar], j[similar])),
+                              shape=(len(candidates), len(candidates)))
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)
+    # clusters numbered from the biggest one
+    cluster_ids = np.empty(len(sizes), dtype=int)
+    cluster_ids[np.lexsort((np.arange(len(sizes)), -sizes))] = np.arange(1, len(sizes) + 1)
+
+    # most similar candidate of each one (every row has at least its diagonal value)
+    jaccard_others = np.where(i == j, -1, jaccard)
+    is_best = (jaccard_others == np.maximum.reduceat(jaccard_others, shared.indptr[:-1])[i]) & (i != j)
+    best_idx = np.flatnonzero(is_best)
+    best_idx = best_idx[np.unique(i[best_idx], return_index=True)[1]]
+    clusters_df = pd.DataFrame({"sample": candidates, "cluster": cluster_ids[labels], "cluster_size": sizes[labels],
+                                "variants": n_variants.astype(int)})
+    best_df = pd.DataFrame({"best_match": candidates[j[best_idx]], "best_shared": n[best_idx].astype(int),
+                            "best_jaccard": jaccard[best_idx].round(3), "best_freq_corr": freq_corr[best_idx].round(3)},
+                           index=i[best_idx])
+    clusters_df = clusters_df.join(best_df)
+    clusters_df = clusters_df.sort_values(["cluster", "variants"], ascending=[True, False], kind="stable")
+    return clusters_df.reset_index(drop=True), pairs_df
+
+
+def cooccurrence_analysis(json_file, output_dir, min_lowfreq=None, percent_dev=0.95, min_depth=10,
+                          min_similarity=0.5):
+    """Looks for candidates that share the same minority variants (see candidates_cooccurrence), for example
+    coinfections with the same pair of lineages or a common contamination. Candidates are selected as in the
+    "candidates" step. Writes candidates_clusters.csv and candidates_pairs.csv"""
+    assert os.path.exists(json_file), f'"{json_file}" does not exists'
+    with open(json_file) as h:
+        data = json.load(h)
+    _, samples_df, _ = long_format_entries(data["entries_data"])
+    mins_df = samples_df[(samples_df.allele_min != "") & (samples_df.depth_min >= min_depth)]
+    _, candidates = select_candidates(mins_df.groupby("sample", sort=False).size(), min_lowfreq, percent_dev)
+
+    clusters_df, pairs_df = candidates_cooccurrence(mins_df, candidates, min_similarity)
+    clusters_df.to_csv(f'{output_dir}/candidates_clusters.csv', index=False)
+    pairs_df.to_csv(f'{output_dir}/candidates_pairs.csv', index=False)
+    print(f"{len(candidates)} candidates in {clusters_df.cluster.nunique()} clusters "
+          f"({(clusters_df.cluster_size > 1).sum()} candidates share minority variants with others)")
+    return clusters_df
+
+
+def read_manifest(manifest):
+    """Reads a batch manifest: one cohort per line with its VCF and its output directory, separated by
+    a tab (paths may contain spaces). Empty lines and lines starting with # are ignored."""
+    cohorts = []
+    with open(manifest) as h:
+        for line in h:
+            if line.strip() and not line.startswith("#"):
+                vec = line.rstrip("\n").split("\t")
+                if len(vec) != 2:
+                    raise ValueError(f'invalid manifest line, "vcf<TAB>out_dir" expected: {line.strip()}')
+                cohorts.append(vec)
+    return cohorts
+
+
+batch_lineage_data = {}
+
+
+def init_batch_worker(lineage_data):
+    # loaded once per worker process instead of once per cohort
+    global batch_lineage_data
+    batch_lineage_data = lineage_data
+
+
+def run_cohort(task):
+    """Runs "iSNVs" and "candidates" for one cohort of a batch. Errors are logged in the cohort directory
+    (log.txt) and reported, without stopping the rest of the batch."""
+    vcf, out_dir, params = task
+    try:
+        os.makedirs(f'{out_dir}/report', exist_ok=True)
+        with open(f'{out_dir}/log.txt', "w") as log, redirect_stdout(log), redirect_stderr(log):
+            try:
+                variant_filter(vcf, f'{out_dir}/data.json', params["isnv_depth"], params["min_coverage"],
+                               params["isnv_freq"], params["badq_strain_ns_threshold"], batch_lineage_data)
+                candidates = comparative_analysis(f'{out_dir}/data.json', f'{out_dir}/report',
+                                                  params["isnv_freq_cutoff"], params["deviation_isnv_freq_cutoff"],
+                                                  min_depth=params["isnv_depth"],
+                                                  plot_formats=params["plot_formats"], processes=1,
+                                                  lineage_data=batch_lineage_data)
+            except (Exception, SystemExit):
+                traceback.print_exc()
+                raise
+    except (Exception, SystemExit) as ex:
+        return vcf, out_dir, "failed", f'{type(ex).__name__}: {ex}'
+    return vcf, out_dir, "ok", f'{len(candidates)} candidates'
+
+
+def batch(manifest, params, lineage_data={}, processes=None):
+    """Processes all the cohorts of a manifest (see read_manifest) in one pool of worker processes.
+    Cohorts are scheduled biggest VCF first, and the ones that fail do not stop the others.
+    Returns the (vcf, out_dir, status, message) of each cohort."""
+    cohorts = read_manifest(manifest)
+    cohorts = sorted(cohorts, key=lambda x: os.path.getsize(x[0]) if os.path.exists(x[0]) else 0, reverse=True)
+    filter_lineage_data(lineage_data)
+    results = []
+    with Pool(processes, initializer=init_batch_worker, initargs=(lineage_data,)) as pool:
+        for result in tqdm(pool.imap_unordered(run_cohort, [(vcf, out_dir, params) for vcf, out_dir in cohorts]),
+                           total=len(cohorts)):
+            results.append(result)
+            tqdm.write("\t".join(result))
+    return results
+
+
+def build_cohort_index(json_file, min_depth=10):
+    """Loads the "iSNVs" output in memory, indexed to answer the "serve" queries:
+    - variant_samples: minority variant -> samples that carry it
+    - sample_variants: sample -> its minority variants
+    - pos_consensus: position -> consensus allele counts
+    - min_counts: number of minority variants per sample, used to select candidates
+    Only minority variants with at least min_depth reads are indexed, as in the "candidates" step"""
+    mtime = os.path.getmtime(json_file)
+    with open(json_file) as h:
+        data = json.load(h)
+    _, samples_df, _ = long_format_entries(data["entries_data"])
+
+    mins_df = samples_df[(samples_df.allele_min != "") & (samples_df.depth_min >= min_depth)]
+    variant_samples = defaultdict(list)
+    sample_variants = {sample: [] for sample in samples_df["sample"].unique()}
+    for sample, variant, ann, freq, depth_min, depth in zip(
+            mins_df["sample"], mins_df.min_variant, mins_df.ann, mins_df.freq_min.tolist(),
+            mins_df.depth_min.tolist(), mins_df.depth.tolist()):
+        variant_samples[variant].append({"sample": sample, "freq": freq, "depth": depth_min, "pos_depth": depth})
+        sample_variants[sample].append({"variant": variant, "ann": ann, "freq": freq, "depth": depth_min,
+                                        "pos_depth": depth})
+
+    pos_consensus = defaultdict(dict)
+    for (pos, allele), count in samples_df.groupby(["pos", "consensus"], sort=False).size().items():
+        pos_consensus[pos][allele] = int(count)
+
+    return {"file": json_file, "mtime": mtime, "loaded": time.time(), "min_depth": min_depth,
+            "variant_samples": dict(variant_samples), "sample_variants": sample_variants,
+            "pos_consensus": dict(pos_consensus),
+            "min_counts": mins_df.groupby("sample", sort=False).size(),
+            "badquality_samples": data["badquality_samples"]}
+
+
+def cohort_query(cohort, path, params):
+    """Answers a "serve" query, path is the list of URL path elements and params the query string values.
+    Returns the HTTP status and the response:
+    - /                       cohort summary
+    - /variant/<pos_ref_alt>  samples with that minority variant
+    - /sample/<sample>        minority variants of the sample
+    - /position/<pos>         consensus allele counts
+    - /candidates             candidates, with the cutoff of the "candidates" command
+                              (?isnv_freq_cutoff=N or ?deviation_isnv_freq_cutoff=0.95)"""
+    if path == [""]:
+        return 200, {"file": cohort["file"], "loaded": cohort["loaded"], "min_depth": cohort["min_depth"],
+                     "samples": len(cohort["sample_variants"]), "variants": len(cohort["variant_samples"]),
+                     "positions": len(cohort["pos_consensus"])}
+    if len(path) == 2 and path[0] == "variant":
+        if path[1] not in cohort["variant_samples"]:
+            return 404, {"error": f'minority variant "{path[1]}" not found'}
+        return 200, {"variant": path[1], "samples": cohort["variant_samples"][path[1]]}
+    if len(path) == 2 and path[0] == "sample":
+        if path[1] not in cohort["sample_variants"]:
+            return 404, {"error": f'sample "{path[1]}" not found'}
+        return 200, {"sample": path[1], "badquality": path[1] in cohort["badquality_samples"],
+                     "isnvs": cohort["sample_variants"][path[1]]}
+    if len(path) == 2 and path[0] == "position":
+        if path[1] not in cohort["pos_consensus"]:
+            return 404, {"error": f'position "{path[1]}" not found'}
+        return 200, {"pos": path[1], "consensus": cohort["pos_consensus"][path[1]]}
+    if path == ["candidates"]:
+        try:
+            min_lowfreq = float(params["isnv_freq_cutoff"]) if "isnv_freq_cutoff" in params else None
+            percent_dev = float(params.get("deviation_isnv_freq_cutoff", 0.95))
+        except ValueError as ex:
+            return 400, {"error": str(ex)}
+        cutoff, candidates = select_candidates(cohort["min_counts"], min_lowfreq, percent_dev)
+        return 200, {"cutoff": float(cutoff),
+                     "candidates": [{"sample": x, "isnvs": int(cohort["min_counts"][x])} for x in candidates]}
+    return 404, {"error": f'invalid query "{"/".join(path)}"'}
+
+
+class CohortRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = [unquote(x) for x in url.path.strip("/").split("/")]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        status, response = cohort_query(self.server.cohort, path, params)
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if os.environ.get("verbose"):
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        # HTTPServer.server_bind expects a (host, port) address
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def watch_cohort(server, json_file, min_depth, interval):
+    """Reloads the cohort when its file changes. Queries are answered with the previous data until the new one
+    is loaded, and if it can not be loaded (for example, the file is still being written) it is tried again"""
+    while True:
+        time.sleep(interval)
+        try:
+            if os.path.getmtime(json_file) != server.cohort["mtime"]:
+                server.cohort = build_cohort_index(json_file, min_depth)
+                sys.stderr.write(f'{json_file} reloaded\n')
+        except Exception:
+            traceback.print_exc()
+
+
+def serve(json_file, min_depth=10, port=8765, unix_socket=None, reload_interval=2):
+    """Serves the queries of cohort_query over HTTP, in localhost or in a unix socket"""
+    assert os.path.exists(json_file), f'"{json_file}" does not exists'
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, CohortRequestHandler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), CohortRequestHandler)
+    server.cohort = build_cohort_index(json_file, min_depth)
+    if reload_interval:
+        threading.Thread(target=watch_cohort, args=(server, json_file, min_depth, reload_interval),
+                         daemon=True).start()
+    sys.stderr.write(f'serving {json_file} at {unix_socket or f"http://127.0.0.1:{port}"}\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -641,6 +1632,15 @@ if __name__ == '__main__':
                      help='fasta file. Can be gziped. Default "data/MN996528.fna"')
     cmd.add_argument('-o', '--output',
                      default='results/variants.vcf.gz', help='output file. Default "results/variants.vcf.gz"')
+    cmd.add_argument('--processes', default=None, type=int,
+                     help='Number of reference intervals genotyped at the same time. Default: number of CPUs')
+    cmd.add_argument('--fix', action='store_true', help='runs vcffixer.py over the output')
+    cmd.add_argument('--isnvs_out', default=None,
+                     help='runs the "iSNVs" step over the output while it is written, and stores its result here')
+    cmd.add_argument('--isnv_depth', default=10, type=int, help='see "iSNVs" command')
+    cmd.add_argument('--min_coverage', default=0.8, type=float, help='see "iSNVs" command')
+    cmd.add_argument('--isnv_freq', default=0.2, type=float, help='see "iSNVs" command')
+    cmd.add_argument('--badq_strain_ns_threshold', default=1000, type=int, help='see "iSNVs" command')
     cmd.add_argument('-v', '--verbose', action='store_true')
 
     cmd = subparsers.add_parser('iSNVs', help='gets a list of iSNVs')
@@ -657,6 +1657,27 @@ if __name__ == '__main__':
 
     cmd.add_argument('--vcf', required=True, help="Multi Sample VCF. GT and AD fields are mandatory")
     cmd.add_argument('--out', default="results/data.json", help="Output data")
+    cmd.add_argument('--lineage_json', default=None,
+                     help='JSON with the lineages of each variant: {"gene:aa": [[lineage, freq], ...]}')
+    cmd.add_argument('--shards', default=None,
+                     help='Directory with per sample partial results. The VCF samples are added to the ones already '
+                          'stored there, so new samples can be added without processing the whole cohort again')
+    cmd.add_argument('--checkpoint_interval', default=300, type=float,
+                     help='Seconds between checkpoints of the VCF parsing, saved in "{out}.checkpoint". '
+                          '0 disables them. Default 300')
+    cmd.add_argument('--resume', action='store_true',
+                     help='Continues from the last checkpoint of an interrupted run with the same VCF and parameters')
+    cmd.add_argument('--isnv_test', default=None, choices=["binomial", "betabinomial"],
+                     help='Selects the minority variants with a test against sequencing errors, corrected for multiple '
+                          'testing (Benjamini-Hochberg) over the whole cohort, instead of --isnv_freq. '
+                          'It can not be used with --shards')
+    cmd.add_argument('--error_rate', default=0.01, type=float,
+                     help='Sequencing error rate used by --isnv_test, between 0 and 1. Default 0.01')
+    cmd.add_argument('--overdispersion', default=0.01, type=float,
+                     help='Overdispersion (intra class correlation) of the betabinomial test, between 0 (binomial) '
+                          'and 1. Default 0.01')
+    cmd.add_argument('--max_fdr', default=0.05, type=float,
+                     help='Max q-value (false discovery rate) of the minority variants with --isnv_test. Default 0.05')
     cmd.add_argument('-v', '--verbose', action='store_true')
 
     cmd = subparsers.add_parser('candidates', help='extract candidates from the dataset')
@@ -682,6 +1703,70 @@ if __name__ == '__main__':
                      help='Minimun allele read depth. Default 10')
 
     cmd.add_argument('--out_dir', default="./results")
+    cmd.add_argument('--plot_formats', '--plot-formats', nargs="+", default=["png", "eps"],
+                     choices=PLOT_FORMATS + ["none"],
+                     help='Figure formats. "none" skips rendering, figures can be rendered later with the "plots" '
+                          'command. Default png eps')
+    cmd.add_argument('--processes', default=None, type=int,
+                     help='Number of processes used to render the figures. Default: number of CPUs')
+    cmd.add_argument('--lineage_json', default=None,
+                     help='JSON with the lineages of each variant: {"gene:aa": [[lineage, freq], ...]}. If it is set, '
+                          'the pairs of lineages that best explain each candidate are added to the report')
+    cmd.add_argument('--min_lineage_freq', default=0.8, type=float,
+                     help='Min fraction of the lineage sequences with a variant to use it as a lineage variant. '
+                          'Default 0.8')
+    cmd.add_argument('-v', '--verbose', action='store_true')
+
+    cmd = subparsers.add_parser('cooccurrence', help='clusters the candidates that share minority variants')
+    cmd.add_argument('--data', required=True, help='JSON file created by "iSNVs" step')
+    cmd.add_argument('--isnv_freq_cutoff', default=None, type=float, help='see "candidates" command')
+    cmd.add_argument('--deviation_isnv_freq_cutoff', default=0.95, type=float, help='see "candidates" command')
+    cmd.add_argument('--isnv_depth', default=10, type=int, help='Minimun allele read depth. Default 10')
+    cmd.add_argument('--min_similarity', default=0.5, type=float,
+                     help='Candidates with at least this fraction of minority variants in common (jaccard) are '
+                          'clustered together. Default 0.5')
+    cmd.add_argument('--out_dir', default="./results")
+    cmd.add_argument('-v', '--verbose', action='store_true')
+
+    cmd = subparsers.add_parser('batch', help='runs "iSNVs" and "candidates" for many cohorts in one process')
+    cmd.add_argument('--manifest', required=True,
+                     help='File with one cohort per line: multi sample VCF and output directory, separated by tabs. '
+                          'Each output directory gets data.json, report/ and log.txt')
+    cmd.add_argument('--isnv_depth', default=10, type=int, help='Min iSNVs read depth. Default 10')
+    cmd.add_argument('--min_coverage', default=0.8, type=float,
+                     help='max percentaje N to discard a position. Between 0.0-1.0 Default 0.8')
+    cmd.add_argument('--isnv_freq', default=0.2, type=float, help='min iSNVs frequency. Between 0.0-1.0 Default 0.2')
+    cmd.add_argument('--badq_strain_ns_threshold', default=1000, type=int,
+                     help='sets the threshold (Ns) to tag a sample as a bad quality one')
+    cmd.add_argument('--lineage_json', default=None,
+                     help='JSON with the lineages of each variant: {"gene:aa": [[lineage, freq], ...]}')
+    cmd.add_argument('--isnv_freq_cutoff', default=None, type=float,
+                     help='see "candidates" command')
+    cmd.add_argument('--deviation_isnv_freq_cutoff', default=0.95, type=float,
+                     help='see "candidates" command')
+    cmd.add_argument('--plot_formats', '--plot-formats', nargs="+", default=["png", "eps"],
+                     choices=PLOT_FORMATS + ["none"], help='Figure formats. Default png eps')
+    cmd.add_argument('--processes', default=None, type=int,
+                     help='Number of cohorts processed at the same time. Default: number of CPUs')
+    cmd.add_argument('-v', '--verbose', action='store_true')
+
+    cmd = subparsers.add_parser('plots', help='renders again the figures of the "candidates" step')
+    cmd.add_argument('--report_dir', required=True,
+                     help='"candidates" output directory (--out_dir), where plots_data.json is located')
+    cmd.add_argument('--plot_formats', '--plot-formats', nargs="+", default=["png", "eps"],
+                     choices=PLOT_FORMATS + ["none"], help='Figure formats. Default png eps')
+    cmd.add_argument('--processes', default=None, type=int,
+                     help='Number of processes used to render the figures. Default: number of CPUs')
+    cmd.add_argument('-v', '--verbose', action='store_true')
+
+    cmd = subparsers.add_parser('serve', help='answers queries over an "iSNVs" output, loaded once in memory')
+    cmd.add_argument('--data', required=True, help='JSON file created by "iSNVs" step')
+    cmd.add_argument('--isnv_depth', default=10, type=int, help='Minimun allele read depth. Default 10')
+    cmd.add_argument('--port', default=8765, type=int, help='HTTP port, only localhost is used. Default 8765')
+    cmd.add_argument('--socket', default=None, help='Unix socket path, used instead of the HTTP port')
+    cmd.add_argument('--reload_interval', default=2, type=float,
+                     help='Seconds between checks of --data changes, it is reloaded if modified. 0 disables it. '
+                          'Default 2')
     cmd.add_argument('-v', '--verbose', action='store_true')
 
     # cmd = subparsers.add_parser('minconsensus', help='creates sequences using minor frequency variants')
@@ -717,7 +1802,7 @@ if __name__ == '__main__':
         for bam_file in glob(args.bams_folder + "/*.bam"):
             sample = bam_file.split("/")[-1].split(".bam")[0]
             e(f"samtools index  {bam_file}")
-            cmd = f"""/gatk/gatk  HaplotypeCaller -ERC GVCF -R {args.reference} \
+            cmd = f"""{GATK}  HaplotypeCaller -ERC GVCF -R {args.reference} \
                 -ploidy 2 -I {bam_file} --output-mode EMIT_ALL_CONFIDENT_SITES -O {args.output}/{sample}.g.vcf.gz"""
             e(cmd)
 
@@ -725,15 +1810,17 @@ if __name__ == '__main__':
         merge_vcfs(args)
 
     elif args.command == 'iSNVs':
-        # if os.path.exists(args.lineage_json):
-        #     with open(args.lineage_json) as h:
-        #         lineage_data = json.load(h)
-        #
-        # else:
-        #     lineage_data = {}
+        if args.lineage_json:
+            with open(args.lineage_json) as h:
+                lineage_data = json.load(h)
+        else:
+            lineage_data = {}
         variant_filter(vcf_path=args.vcf, outpath=args.out, min_allele_depth=args.isnv_depth,
                        min_coverage=args.min_coverage,min_freq=args.isnv_freq,
-                       badq_strain_ns_threshold=args.badq_strain_ns_threshold)
+                       badq_strain_ns_threshold=args.badq_strain_ns_threshold, lineage_data=lineage_data,
+                       shards_dir=args.shards, resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+                       isnv_test=args.isnv_test, error_rate=args.error_rate, overdispersion=args.overdispersion,
+                       max_fdr=args.max_fdr)
 
     elif args.command == 'candidates':
         if not os.path.exists(args.out_dir):
@@ -741,9 +1828,48 @@ if __name__ == '__main__':
         assert os.path.exists(args.out_dir), f'"{args.out_dir}" could not be created'
         # comparative_analysis(json_file, output_dir, min_lowfreq=None, min_depth=10):
 
+        if args.lineage_json:
+            with open(args.lineage_json) as h:
+                lineage_data = json.load(h)
+            filter_lineage_data(lineage_data)
+        else:
+            lineage_data = None
         candidates = comparative_analysis(args.data, args.out_dir, args.isnv_freq_cutoff,
                                           args.deviation_isnv_freq_cutoff,
-                                          min_depth=args.isnv_depth)
+                                          min_depth=args.isnv_depth, plot_formats=args.plot_formats,
+                                          processes=args.processes, lineage_data=lineage_data,
+                                          min_lineage_freq=args.min_lineage_freq)
+
+    elif args.command == 'cooccurrence':
+        if not os.path.exists(args.out_dir):
+            os.makedirs(args.out_dir)
+        cooccurrence_analysis(args.data, args.out_dir, args.isnv_freq_cutoff, args.deviation_isnv_freq_cutoff,
+                              min_depth=args.isnv_depth, min_similarity=args.min_similarity)
+
+    elif args.command == 'batch':
+        if args.lineage_json:
+            with open(args.lineage_json) as h:
+                lineage_data = json.load(h)
+        else:
+            lineage_data = {}
+        params = {k: getattr(args, k) for k in ["isnv_depth", "min_coverage", "isnv_freq", "badq_strain_ns_threshold",
+                                               "isnv_freq_cutoff", "deviation_isnv_freq_cutoff", "plot_formats"]}
+        results = batch(args.manifest, params, lineage_data, args.processes)
+        failed = [x for x in results if x[2] != "ok"]
+        if failed:
+            sys.stderr.write(f"{len(failed)} of {len(results)} cohorts failed\n")
+            sys.exit(1)
+
+    elif args.command == 'plots':
+        plots_data_file = f'{args.report_dir}/plots_data.json'
+        assert os.path.exists(plots_data_file), f'"{plots_data_file}" does not exists'
+        with open(plots_data_file) as h:
+            plots_data = json.load(h)
+        for output_file in render_plots(plots_data, args.report_dir, args.plot_formats, args.processes):
+            print(output_file)
+
+    elif args.command == 'serve':
+        serve(args.data, args.isnv_depth, args.port, args.socket, args.reload_interval)
 
     else:
         sys.stderr.write(f"Invalid command: {args.command}")
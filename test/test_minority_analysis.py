@@ -0,0 +1,295 @@
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import binom
+import minority_analysis
+from minority_analysis import variant_filter, freq_histogram, add_freq, merge_histograms, histogram_stats, \
+    build_cohort_index, cohort_query, parse_vcf, HET_GT, candidates_cooccurrence, lineage_mixtures, popcount, \
+    pack_bits, bh_adjust, isnv_qvalues, comparative_analysis, merge_vcfs, render_plots, \
+    batch
+
+ann = "ANN=T|missense_variant|MODERATE|S|Gene_21562_25383|transcript|QHR63260.2|protein_coding|1/1|c.3815A>G|p.Tyr1272Cys|3815/3822|3815/3822|1272/1273||"
+samples = ["s1", "s2", "s3", "s4"]
+sites = {
+    100: ["A", "T", ["0/1:80,40:120", "0/0:100,0:100", "0/0:90,1:91", "1/1:0,70:70"]],
+    101: ["C", "T", ["0/0:100,0:100", "./.:0,0:0", "0/1:50,30:80", "0/0:60,0:60"]],
+    200: ["G", "T,C", ["0/0:100,0,0:100", "0/2:70,0,35:105", "0/0:90,0,1:91", "0/1:40,25,0:65"]],
+    300: ["T", "A", ["1/1:0,100:100", "1/1:0,70:70", "0/1:30,60:90", "./.:0,0:0"]],
+}
+
+
+def write_vcf(path, sample_idxs, positions):
+    with open(path, "w") as h:
+        h.write("##fileformat=VCFv4.2\n")
+        h.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] +
+                          [samples[i] for i in sample_idxs]) + "\n")
+        for pos in positions:
+            ref, alts, calls = sites[pos]
+            h.write("\t".join(["MN996528.1", str(pos), ".", ref, alts, "100", ".", "AC=1;" + ann, "GT:AD:DP"] +
+                              [calls[i] if i is not None else "./.:.:." for i in sample_idxs]) + "\n")
+
+
+def test_shards_match_full_run(tmp_path):
+    params = dict(min_allele_depth=10, min_coverage=0.7, min_freq=0.2, badq_strain_ns_threshold=1)
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    variant_filter(str(tmp_path / "all.vcf"), str(tmp_path / "full.json"), **params)
+
+    write_vcf(tmp_path / "a.vcf", [0, 1], sorted(sites))
+    write_vcf(tmp_path / "b.vcf", [2, 3], sorted(sites))
+    variant_filter(str(tmp_path / "a.vcf"), str(tmp_path / "a.json"), shards_dir=str(tmp_path / "shards"), **params)
+    variant_filter(str(tmp_path / "b.vcf"), str(tmp_path / "inc.json"), shards_dir=str(tmp_path / "shards"), **params)
+
+    with open(tmp_path / "full.json") as h:
+        full = json.load(h)
+    with open(tmp_path / "inc.json") as h:
+        assert json.load(h) == full
+    assert sorted(full["entries_data"]) == ["100", "101", "200", "300"]
+
+
+def test_het_gt_prefilter():
+    for call in ["0/1", "0|1", "1/10", "10/1", "0/.", "./1", "1/1/2"]:
+        assert HET_GT.search(f"GT:AD:DP\t0/0:10,0:10\t{call}:5,5:10\n"), call
+    for call in ["0/0", "1|1", "10/10", "./.", "1"]:
+        assert not HET_GT.search(f"GT:AD:DP\t0/0:10,0:10\t{call}:5,5:10\t{call}:3,0:3\n"), call
+
+
+def test_candidates_cooccurrence():
+    mins_df = pd.DataFrame([("a", "1_A_G", 0.2), ("a", "2_C_T", 0.3), ("a", "3_G_A", 0.4),
+                            ("b", "1_A_G", 0.25), ("b", "2_C_T", 0.35), ("b", "3_G_A", 0.45), ("b", "9_T_C", 0.3),
+                            ("c", "3_G_A", 0.3), ("c", "5_A_T", 0.2)],
+                           columns=["sample", "min_variant", "freq_min"])
+    clusters_df, pairs_df = candidates_cooccurrence(mins_df, ["c", "a", "b"], min_similarity=0.5)
+    clusters = clusters_df.set_index("sample")
+    assert clusters.cluster["a"] == clusters.cluster["b"] == 1 and clusters.cluster["c"] == 2
+    assert clusters.best_match["a"] == "b" and clusters.best_shared["a"] == 3
+    assert clusters.best_jaccard["a"] == 0.75 and clusters.best_freq_corr["a"] == 1.0
+    assert list(pairs_df[["sample1", "sample2"]].iloc[0]) == ["a", "b"] and len(pairs_df) == 1
+    # constant frequencies: no correlation
+    mins_df = pd.DataFrame([("b", "1_A_G", 0.1), ("b", "2_C_T", 0.7), ("b", "3_G_A", 0.3),
+                            ("c", "1_A_G", 0.1), ("c", "2_C_T", 0.1), ("c", "3_G_A", 0.1)],
+                           columns=["sample", "min_variant", "freq_min"])
+    clusters_df, pairs_df = candidates_cooccurrence(mins_df, ["b", "c"])
+    assert np.isnan(pairs_df.freq_corr[0]) and clusters_df.best_freq_corr.isna().all()
+
+
+
+def test_lineage_mixtures():
+    bits = pack_bits(pd.DataFrame([[True] * 70 + [False] * 3, [False, True] * 36 + [True]]).values)
+    assert list(popcount(bits)) == [70, 37]
+    positions_df = pd.DataFrame([(str(p), p, "A", "S", "", f"X{p}Y", "") for p in range(1, 6)],
+                                columns=["pos", "pos_num", "ref", "gene", "gene_nt", "gene_aa", "lineages"]
+                                ).set_index("pos")
+    # consensus of L1 and minority variants of L2
+    samples_df = pd.DataFrame([(str(p), "a", "A", cons, allele_min, freq, 100, int(freq * 100), cons)
+                               for p, cons, allele_min, freq in [(1, "G", "", 0), (2, "G", "", 0), (3, "A", "G", 0.3),
+                                                                 (4, "A", "G", 0.3), (5, "A", "", 0)]],
+                              columns=["pos", "sample", "ref", "consensus_aln", "allele_min", "freq_min", "depth",
+                                       "depth_min", "consensus"])
+    lineage_data = {"S:X1Y": [["L1", 1.0], ["L3", 0.9]], "S:X2Y": [["L1", 0.95]], "S:X3Y": [["L2", 1], ["L3", 0.9]],
+                    "S:X4Y": [["L2", 1], ["L1", 0.1]], "S:X5Y": [["L4", 1]]}
+    best = lineage_mixtures(samples_df, positions_df, ["a"], lineage_data).iloc[0]
+    assert (best["major"], best["minor"], best["minor_proportion"], best["score"]) == ("L1", "L2", 0.3, 1)
+    assert (best["explained"], best["missing"], best["unexpected"]) == (4, 0, 0)
+
+
+
+def test_isnv_qvalues():
+    assert list(bh_adjust(np.array([0.01, 0.04, 0.03, 0.5])).round(4)) == [0.04, 0.0533, 0.0533, 0.5]
+    variants = {"1": {"a": ({"A": 1, "G": 1}, {"A": 95, "G": 5}, "A", None),
+                      "b": ({"A": 1, "G": 1}, {"A": 60, "G": 40}, "A", None),
+                      "c": ({"A": 1}, {"A": 100}, "A", None)}}
+    qvalues, tests = isnv_qvalues(variants, error_rate=0.01)
+    assert tests == 2 and ("1", "c") not in qvalues
+    assert qvalues[("1", "a")] == pytest.approx(binom.sf(4, 100, 0.01))
+    assert qvalues[("1", "b")] < qvalues[("1", "a")]
+    qvalues, _ = isnv_qvalues(variants, error_rate=0.01, test="betabinomial", overdispersion=0.05)
+    assert qvalues[("1", "a")] > binom.sf(4, 100, 0.01)
+    qvalues, _ = isnv_qvalues(variants, error_rate=0.01, test="betabinomial", overdispersion=0)
+    assert qvalues[("1", "a")] == pytest.approx(binom.sf(4, 100, 0.01))
+
+
+@pytest.mark.parametrize("params", [{"error_rate": 0}, {"error_rate": 1}, {"overdispersion": 1},
+                                    {"overdispersion": -0.1}])
+def test_isnv_test_params(tmp_path, params):
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    with pytest.raises(SystemExit):
+        variant_filter(str(tmp_path / "all.vcf"), str(tmp_path / "data.json"), min_allele_depth=10, min_coverage=0.7,
+                       min_freq=0.2, badq_strain_ns_threshold=1, isnv_test="betabinomial", **params)
+
+
+def test_resume_from_checkpoint(tmp_path, monkeypatch):
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    full = parse_vcf(str(tmp_path / "all.vcf"), 10)
+
+    def interrupted(lines):
+        for i, line in enumerate(lines):
+            if i == 4:
+                raise KeyboardInterrupt
+            yield line
+
+    checkpoint = str(tmp_path / "data.json.checkpoint")
+    monkeypatch.setattr(minority_analysis, "tqdm", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        parse_vcf(str(tmp_path / "all.vcf"), 10, checkpoint=checkpoint, checkpoint_interval=0)
+    monkeypatch.undo()
+    assert (tmp_path / "data.json.checkpoint").exists()
+    assert parse_vcf(str(tmp_path / "all.vcf"), 10, checkpoint=checkpoint, resume=True) == full
+
+
+def test_freq_histograms_merge():
+    freqs = [0.2, 0.25, 0.25, 0.31, 0.5, 0.999, 1.0]
+    full, h1, h2 = freq_histogram(), freq_histogram(), freq_histogram()
+    for i, f in enumerate(freqs):
+        add_freq(full, f)
+        add_freq(h1 if i % 2 else h2, f)
+    merged = merge_histograms(h1, h2)
+    assert merged["counts"] == full["counts"]
+    assert merge_histograms(full, h1, sign=-1) == h2
+    stats = histogram_stats(merged)
+    assert stats["n"] == len(freqs)
+    assert abs(stats["mean"] - sum(freqs) / len(freqs)) < 0.0001
+    assert stats["q50"] == 0.3105
+    assert len(full["counts"]) == full["bins"]
+
+
+
+def run_candidates(tmp_path, vcf_text=None, plot_formats=()):
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    if vcf_text:
+        (tmp_path / "all.vcf").write_text(vcf_text((tmp_path / "all.vcf").read_text()))
+    variant_filter(str(tmp_path / "all.vcf"), str(tmp_path / "data.json"), min_allele_depth=10, min_coverage=0.7,
+                   min_freq=0.2, badq_strain_ns_threshold=1)
+    (tmp_path / "report").mkdir()
+    comparative_analysis(str(tmp_path / "data.json"), str(tmp_path / "report"), min_lowfreq=0.5, plot_formats=plot_formats)
+    return tmp_path / "report"
+
+
+def test_candidates_report_golden(tmp_path):
+    # expected reports were created with the original (per sample loop) implementation
+    report = run_candidates(tmp_path)
+    expected = os.path.join(os.path.dirname(__file__), "data", "candidates_report")
+    for name in sorted(os.listdir(expected)):
+        with open(os.path.join(expected, name)) as h:
+            assert (report / name).read_text() == h.read(), name
+
+
+def test_candidates_sample_without_first_position(tmp_path):
+    # s4 is not called (no AD) in the first position
+    report = run_candidates(tmp_path, lambda text: text.replace("1/1:0,70:70", "./.:.:.", 1))
+    with open(report / "plots_data.json") as h:
+        assert json.load(h)["min_variants_count"]["sample_counts"] == [1, 1, 2, 1]
+
+
+def test_render_plots_from_plots_data(tmp_path):
+    report = run_candidates(tmp_path, plot_formats=("none",))
+    assert not [name for name in os.listdir(report) if name.endswith((".png", ".eps", ".pdf", ".svg"))]
+    with open(report / "plots_data.json") as h:
+        plots_data = json.load(h)
+    assert render_plots(plots_data, str(report), ("pdf",), processes=1) == [
+        f"{report}/{name}.pdf" for name in ["min_variants_count_per_sample", "min_variants_count_per_sample_with_0",
+                                            "isnvs_freqs", "candidates_freqs"]]
+    for name in ["min_variants_count_per_sample", "min_variants_count_per_sample_with_0", "isnvs_freqs",
+                 "candidates_freqs"]:
+        assert (report / f"{name}.pdf").stat().st_size > 0
+    assert render_plots({}, str(report), ("pdf",)) == []
+
+
+# GATK stand-in: CombineGVCFs copies the first --variant, GenotypeGVCFs keeps the records that start in -L.
+# The interval that starts in STUB_FAIL_START fails without output
+gatk_stub = """
+import gzip, os, shutil, sys
+args = sys.argv[1:]
+opt = lambda k: args[args.index(k) + 1]
+if args[0] == "CombineGVCFs":
+    with open(opt("--variant"), "rb") as h, gzip.open(opt("-O"), "wb") as o:
+        shutil.copyfileobj(h, o)
+else:
+    contig, interval = opt("-L").rsplit(":", 1)
+    start, end = map(int, interval.split("-"))
+    if os.environ.get("STUB_FAIL_START") == str(start):
+        sys.exit(1)
+    with gzip.open(opt("-V"), "rt") as h, gzip.open(opt("-O"), "wt") as o:
+        for line in h:
+            if line.startswith("#") or (line.split("\t")[0] == contig and start <= int(line.split("\t")[1]) <= end):
+                o.write(line)
+"""
+
+
+def test_merge_vcfs_with_stub_executables(tmp_path, monkeypatch):
+    (tmp_path / "gatk.py").write_text(gatk_stub)
+    monkeypatch.setattr(minority_analysis, "GATK", f"{sys.executable} {tmp_path / 'gatk.py'}")
+    monkeypatch.setattr(minority_analysis, "SNPEFF", [sys.executable, "-c", "import shutil, sys; "
+                                                      "shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)"])
+    (tmp_path / "vcfs").mkdir()
+    write_vcf(tmp_path / "vcfs" / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    (tmp_path / "ref.fna.fai").write_text("MN996528.1\t400\t12\t60\t61\n")
+    (tmp_path / "ref.fna").write_text(">MN996528.1\n")
+    out = tmp_path / "out"
+    args = argparse.Namespace(vcfs_dir=str(tmp_path / "vcfs"), reference=str(tmp_path / "ref.fna"),
+                              output=str(out / "all.vcf"), processes=4, fix=False,
+                              isnvs_out=str(out / "data.json"), isnv_depth=10, min_coverage=0.7, isnv_freq=0.2,
+                              badq_strain_ns_threshold=1)
+    # a part of an interrupted run, for the interval that fails (101-200)
+    out.mkdir()
+    with gzip.open(out / "all.vcf.part1.vcf.gz", "wt") as h:
+        h.write("##fileformat=VCFv4.2\n")
+    monkeypatch.setenv("STUB_FAIL_START", "101")
+    with pytest.raises(RuntimeError):
+        merge_vcfs(args)
+    assert sorted(os.listdir(out)) == ["all.vcf.raw.gz"]
+
+    monkeypatch.delenv("STUB_FAIL_START")
+    merge_vcfs(args)
+    assert sorted(os.listdir(out)) == ["all.vcf", "all.vcf.raw.gz", "data.json"]
+    assert (out / "all.vcf").read_text() == (tmp_path / "vcfs" / "all.vcf").read_text()
+    variant_filter(str(tmp_path / "vcfs" / "all.vcf"), str(tmp_path / "data.json"), min_allele_depth=10,
+                   min_coverage=0.7, min_freq=0.2, badq_strain_ns_threshold=1, checkpoint_interval=0)
+    assert (out / "data.json").read_text() == (tmp_path / "data.json").read_text()
+
+
+def test_batch_isolates_failed_cohorts(tmp_path):
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    good, bad = tmp_path / "good cohort", tmp_path / "bad"
+    (tmp_path / "cohorts.tsv").write_text(f"# vcf\tout_dir\n{tmp_path / 'all.vcf'}\t{good}\n"
+                                          f"{tmp_path / 'missing.vcf'}\t{bad}\n")
+    params = dict(isnv_depth=10, min_coverage=0.7, isnv_freq=0.2, badq_strain_ns_threshold=1, isnv_freq_cutoff=0.5,
+                  deviation_isnv_freq_cutoff=0.95, plot_formats=["none"])
+    results = {out_dir: (status, message) for _, out_dir, status, message in
+               batch(str(tmp_path / "cohorts.tsv"), params, processes=2)}
+    assert results[str(good)] == ("ok", "4 candidates")
+    assert results[str(bad)] == ("failed", "SystemExit: 1")
+    assert (good / "data.json").exists() and (good / "report" / "candidates_summary.csv").exists()
+    assert not (bad / "data.json").exists() and "missing.vcf" in (bad / "log.txt").read_text()
+
+    cmd = subprocess.run([sys.executable, minority_analysis.__file__, "batch", "--manifest",
+                          str(tmp_path / "cohorts.tsv"), "--processes", "2", "--plot_formats", "none",
+                          "--min_coverage", "0.7", "--badq_strain_ns_threshold", "1"], capture_output=True, text=True)
+    assert cmd.returncode == 1 and "1 of 2 cohorts failed" in cmd.stderr
+
+
+def test_cohort_queries(tmp_path):
+    write_vcf(tmp_path / "all.vcf", [0, 1, 2, 3], sorted(sites))
+    with open(tmp_path / "all.vcf", "a") as h:
+        h.write("\t".join(["MN996528.1", "3539", ".", "GCTA", "G", "100", ".", "AC=2;" + ann, "GT:AD:DP",
+                           "0/0:100,0:100", "0/0:90,0:90", "1/1:0,80:80", "0/1:30,65:95"]) + "\n")
+    variant_filter(str(tmp_path / "all.vcf"), str(tmp_path / "data.json"), min_allele_depth=10, min_coverage=0.7,
+                   min_freq=0.2, badq_strain_ns_threshold=1)
+    cohort = build_cohort_index(str(tmp_path / "data.json"), min_depth=10)
+
+    status, response = cohort_query(cohort, ["sample", "s1"], {})
+    assert status == 200
+    assert [x["variant"] for x in response["isnvs"]] == ["100_A_T"]
+    status, response = cohort_query(cohort, ["variant", "200_G_C"], {})
+    assert [x["sample"] for x in response["samples"]] == ["s2"]
+    assert cohort_query(cohort, ["position", "300"], {})[1]["consensus"] == {"A": 3, "N": 1}
+    assert cohort_query(cohort, ["position", "3539"], {})[1]["consensus"] == {"GCTA": 2, "G": 2}
+    status, response = cohort_query(cohort, ["candidates"], {"isnv_freq_cutoff": "0.5"})
+    assert sorted(x["sample"] for x in response["candidates"]) == ["s1", "s2", "s3", "s4"]
+    assert cohort_query(cohort, ["sample", "s9"], {})[0] == 404
+    assert cohort_query(cohort, ["candidates"], {"isnv_freq_cutoff": "x"})[0] == 400
@@ -1,4 +1,9 @@
-from vcffixer import reduce_seqs,fix_lines
+import io
+import os
+import random
+import time
+from collections import Counter
+from vcffixer import reduce_seqs,fix_lines,write_block
 test_lines = """MN996528.1	28281	.	A	T	153056.73	.	AC=6;AF=1.00;AN=6;BaseQRankSum=-1.048e+00;DP=3510;ExcessHet=0.0000;FS=0.000;MLEAC=6;MLEAF=1.00;MQ=59.99;MQRankSum=0.00;QD=25.00;ReadPosRankSum=0.869;SOR=0.349	GT:AD:DP:GQ:PGT:PID:PL:PS	1/1:0,1007:1009:99:.:.:46003,3112,0	1|1:1,1215:1216:99:1|1:28280_G_C:54166,3615,0:28280	0/0:0,1157:1159:99:.:.:52901,3579,0
 MN996528.1	28282	.	T	A	125013.73	.	AC=6;AF=1.00;AN=6;BaseQRankSum=-1.021e+00;DP=3513;ExcessHet=0.0000;FS=0.000;MLEAC=6;MLEAF=1.00;MQ=59.99;MQRankSum=-3.300e-02;QD=29.56;ReadPosRankSum=0.936;SOR=0.559	GT:AD:DP:GQ:PGT:PID:PL:PS	1/1:0,1007:1009:99:.:.:46003,3112,0	1|1:3,1210:1213:99:1|1:28280_G_C:53911,3556,0:28280	1|1:0,1156:1158:99:1|1:28280_G_C:52867,3576,0:28280
 MN996528.1	28881	.	G	A	156874.73	.	AC=6;AF=1.00;AN=6;BaseQRankSum=3.10;DP=5754;ExcessHet=0.0000;FS=0.000;MLEAC=6;MLEAF=1.00;MQ=59.99;MQRankSum=0.00;QD=30.49;ReadPosRankSum=2.72;SOR=0.644	GT:AD:DP:GQ:PGT:PID:PL:PS	1/1:3,1523:1532:99:.:.:64341,4583,0	1/1:0,1841:1849:99:.:.:87738,5911,0	0|0:0,1778:1993:99:1|1:28881_G_*:81941,5553,0:28881
@@ -23,5 +28,63 @@ def test_fix_lines_simple():
     print(fix_lines(test_lines[6:8],["s1","s2","s3"]))
     print(fix_lines(test_lines[8:11],["s1","s2","s3"]))
 
+def test_fix_lines_long_run():
+    # worst case: a long run of adjacent positions, each sample with its own haplotype
+    samples = [f"s{i}" for i in range(20)]
+    lines = []
+    haplotypes = {s: ["", ""] for s in samples}
+    for i in range(500):
+        gts = [f"{(i + j) % 2}/{(i * j) % 3 % 2}" for j in range(len(samples))]
+        for s, gt in zip(samples, gts):
+            for k, x in enumerate(gt.split("/")):
+                haplotypes[s][k] += "AG"[int(x)]
+        lines.append("\t".join(["MN996528.1", str(100 + i), ".", "A", "G", "100", ".", "AC=1", "GT:AD:DP"] +
+                               [gt + ":10,5:15" for gt in gts]) + "\n")
+    vec = fix_lines(lines, samples).split("\t")
+    assert vec[3] == "A" * 500
+    alleles = [vec[3]] + vec[4].split(",")
+    for s, call in zip(samples, vec[9:]):
+        gt1, gt2 = call.split(":")[0].split("/")
+        assert [alleles[int(gt1)], alleles[int(gt2)]] == haplotypes[s]
+
+
+def test_fix_lines_fallback():
+    hw = io.StringIO()
+    fallbacks = Counter()
+    lines = [x + "\n" for x in test_lines[:2]]
+    lines[1] = lines[1].replace("1|1:3,1210", "./.:3,1210")
+    write_block(hw, lines, ["s1", "s2", "s3"], fallbacks)
+    assert hw.getvalue() == "".join(lines)
+    assert fallbacks == {"ValueError": 1}
+
+
+def adjacent_run(ref, alt, run, samples, seed=1):
+    # adjacent records, each sample heterozygous in 10% of them
+    rng = random.Random(seed)
+    return ["\t".join(["MN996528.1", str(100 + i), ".", ref, alt, "100", ".", "AC=1", "GT:AD:DP"] +
+                      [("0/0" if rng.random() < 0.9 else "0/1") + ":10,5:15" for _ in samples]) + "\n"
+            for i in range(run)]
+
+
+def test_fix_lines_benchmark():
+    # worst case runs (SNPs and overlapping deletions). Timings are only checked with VCFFIXER_BENCHMARK=1:
+    # the time must grow linearly with the run length
+    samples = [f"s{i}" for i in range(50)]
+    for ref, alt in [("A", "G"), ("AC", "A")]:
+        times = {}
+        for run in [500, 2000]:
+            lines = adjacent_run(ref, alt, run, samples)
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                vec = fix_lines(lines, samples).split("\t")
+                best = min(best, time.perf_counter() - start)
+            assert len(vec[3]) == run + len(ref) - 1
+            times[run] = best
+        print(f"{ref}>{alt} run of 500: {times[500]:.3f}s, run of 2000: {times[2000]:.3f}s")
+        if os.environ.get("VCFFIXER_BENCHMARK"):
+            # 4 times longer run: ~4x if linear, 16x if quadratic
+            assert times[2000] < 8 * times[500] and times[2000] < 5
+
 test_reduce_seqs()
 test_fix_lines_simple()
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 import os
 import sys
+from collections import Counter
 
 def reduce_seqs(first,second,idx):
     """
@@ -24,56 +25,81 @@ def reduce_seqs(first,second,idx):
 
 
 
+def extend_seq(first, second, idx):
+    """
+    reduce_seqs over a list of chars, that is modified in place: only its tail (from idx) is copied, so a block of
+    adjacent positions is merged in time proportional to its number of lines
+    """
+    if not first:
+        first.extend(second)
+    elif len(first) == 1:
+        first.extend(second)
+    elif second != "*":
+        if (len(first) > (idx + 1 )):
+            assert (first[idx:] == list(second[idx:len(first)-1]))
+        tail = second[len(first) - idx:]
+        del first[idx + 1:]
+        first.extend(tail)
+
+
 def fix_lines(lines, samples):
 
     if len(lines) == 1:
         return lines[0]
-    final_ref = ""
+    final_ref = []
 
-    sample_gts1 = {s: "" for s in samples}
-    sample_gts2 = {s: "" for s in samples}
+    sample_gts1 = [[] for _ in samples]
+    sample_gts2 = [[] for _ in samples]
     for idx_line, l in enumerate(lines):
         vec = l.split()
         ref = vec[3]
         # pos = int(vec[1])
-        alts = {i: x for i, x in enumerate(vec[4].split(","))}
-
-        gt_options = {k + 1: v for k, v in alts.items()}
-        gt_options[0] = ref
+        gt_options = [ref] + vec[4].split(",")
 
-        final_ref=reduce_seqs(final_ref,ref,idx_line)
+        extend_seq(final_ref, ref, idx_line)
         # ref = "".join([ref_tmp[i] for i in range(pos - i, pos)]) + ref
 
-        format_f = vec[8]
-        for idx, sample in enumerate(samples):
-            gt_index = [i for i, x in enumerate(format_f.split(":")) if x == "GT"][0]
-            gt = vec[9 + idx].split(":")[gt_index].replace("|","/")
-            gt1,gt2 = gt.split("/")
-            gt1,gt2 = int(gt1),int(gt2)
-            sample_gts1[sample] = reduce_seqs(sample_gts1[sample],gt_options[gt1],idx_line)
-            sample_gts2[sample] = reduce_seqs(sample_gts2[sample],gt_options[gt2],idx_line)
-    alts = list(set(list(sample_gts1.values()) + list(sample_gts2.values())) - set([final_ref]) )
-    ref_and_alts = [final_ref] + alts
-    gts = []
-    for sample in samples:
-        alt1 = sample_gts1[sample]
-        alt2 = sample_gts2[sample]
-        alt = str(ref_and_alts.index(alt1)) + "/" + str(ref_and_alts.index(alt2))
-        gts.append(alt)
+        gt_index = vec[8].split(":").index("GT")
+        gt_alleles = {}
+        for idx in range(len(samples)):
+            gt = vec[9 + idx].split(":", gt_index + 1)[gt_index]
+            if gt not in gt_alleles:
+                gt1,gt2 = gt.replace("|","/").split("/")
+                gt_alleles[gt] = (gt_options[int(gt1)], gt_options[int(gt2)])
+            for seq, allele in zip((sample_gts1[idx], sample_gts2[idx]), gt_alleles[gt]):
+                if len(seq) == idx_line and allele != "*":
+                    # no overlap with the previous alleles
+                    seq.extend(allele)
+                else:
+                    extend_seq(seq, allele, idx_line)
+    final_ref = "".join(final_ref)
+    sample_gts1 = ["".join(x) for x in sample_gts1]
+    sample_gts2 = ["".join(x) for x in sample_gts2]
+    alts = list(set(sample_gts1 + sample_gts2) - set([final_ref]) )
+    allele_index = {allele: str(i) for i, allele in enumerate([final_ref] + alts)}
 
     new_lines = lines[0].split("\t")
     new_lines[3] = final_ref
     new_lines[4] = ",".join(alts)
 
     for idx,s in enumerate(samples):
-        new_lines[9 + idx] = gts[idx] + ":" + ":".join(new_lines[9 + idx].split(":")[1:])
-
-
+        gt = allele_index[sample_gts1[idx]] + "/" + allele_index[sample_gts2[idx]]
+        new_lines[9 + idx] = gt + ":" + new_lines[9 + idx].partition(":")[2]
 
     return "\t".join(new_lines)
 
 
-
+def write_block(hw, lines, samples, fallbacks):
+    """Writes a block of adjacent positions merged in one line (fix_lines). If they can not be merged they are
+    written unchanged, and counted by error in fallbacks"""
+    try:
+        hw.write(fix_lines(lines, samples))
+    except Exception as ex:
+        fallbacks[type(ex).__name__] += 1
+        if os.environ.get("verbose"):
+            sys.stderr.write(f"{len(lines)} lines from {lines[0].split()[1]} not merged: {type(ex).__name__} {ex}\n")
+        for l in lines:
+            hw.write(l)
 
 
 if __name__ == '__main__':
@@ -100,6 +126,7 @@ if __name__ == '__main__':
             h = sys.stdin
         prevlines = []
         prevpos = None
+        fallbacks = Counter()
         for l in h:
             if l.startswith("#CHROM"):
                 samples = l.split()[9:]
@@ -116,17 +143,15 @@ if __name__ == '__main__':
                         prevlines.append(l)
                         prevpos = pos
                     else:
-                        try:
-                            fixed_lines = fix_lines(prevlines, samples)
-                            hw.write(fixed_lines)
-                        except:
-                            for l in  prevlines:
-                                hw.write(l)
-
+                        write_block(hw, prevlines, samples, fallbacks)
 
                         prevlines = [l]
                         prevpos = pos
-        hw.write(fix_lines(prevlines, samples))
+        if prevlines:
+            write_block(hw, prevlines, samples, fallbacks)
+        if fallbacks:
+            sys.stderr.write(f"{sum(fallbacks.values())} blocks of adjacent positions could not be merged and were "
+                             f"written unchanged: {dict(fallbacks)}\n")
     finally:
         if args.vcf_in != "-":
             h.close()